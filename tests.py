@@ -1,259 +1,4045 @@
+import os
+import re
 import sys
+import glob
 import json
 import time
+import string
+import socket
+import random
+import mmap
+import codecs
+import sqlite3
+import hashlib
+import tempfile
+import asyncio
+import itertools
+import concurrent.futures
 import requests
+import urllib3
+import threading
 import subprocess
 import traceback
+import http.server
 
+import struct
+import bisect
+import copy
 import argparse
+import functools
+import contextlib
+import contextvars
+import collections
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# py-evm, for the in-process EVMClient. Imported on first use (see import_evm)
+eth = None
+eth_keys = None
+
+## Transport
+
+class Transport:
+    """Sends an encoded JSON-RPC payload to an endpoint, returns the raw body"""
+
+    headers = {"Content-Type": "application/json"}
+
+    # False when responses don't come from a live node, so there is no
+    # point in waiting between polls
+    realtime = True
+
+    def send(self, url, data, stream=False):
+        raise NotImplementedError()
+
+    def post(self, url, data):
+        return self.check(self.send(url, data)).content
+
+    # Yields the body in chunks as it arrives. Above `spool_threshold` bytes
+    # the body is spooled to a temporary file first (freeing the connection)
+    # and the chunks are slices of a memory map of that file
+    def post_stream(self, url, data, chunk_size=1 << 16, spool_threshold=None):
+        with self.check(self.send(url, data, stream=True)) as resp:
+            if spool_threshold is None:
+                yield from resp.iter_content(chunk_size)
+                return
+            spool = tempfile.SpooledTemporaryFile(max_size=spool_threshold)
+            for chunk in resp.iter_content(chunk_size):
+                spool.write(chunk)
+        with spool:
+            size = spool.tell()
+            if size <= spool_threshold: # Still in memory
+                spool.seek(0)
+                yield from iter(lambda: spool.read(chunk_size), b"")
+                return
+            spool.flush()
+            with mmap.mmap(spool.fileno(), size, access=mmap.ACCESS_READ) as mapped:
+                view = memoryview(mapped)
+                try:
+                    for offset in range(0, size, chunk_size):
+                        yield view[offset:offset + chunk_size]
+                finally:
+                    view.release()
+
+    @staticmethod
+    def check(resp):
+        if resp.status_code != 200:
+            raise Exception(resp.text)
+        return resp
+
+class SimpleTransport(Transport):
+    """Opens a new connection for every call"""
+
+    def __init__(self, timeout=None):
+        self.timeout = timeout
+
+    def send(self, url, data, stream=False):
+        return requests.post(url, headers=self.headers, data=data,
+                             timeout=self.timeout, stream=stream)
+
+# Calls callbacks at their deadline, unless cancelled before, from a single
+# thread (started on first use) instead of a timer thread per call
+class Watchdog:
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.pending = {}
+        self.keys = itertools.count()
+        self.thread = None
+
+    def add(self, deadline, callback):
+        with self.cond:
+            key = next(self.keys)
+            earliest = min(self.pending.values(), default=None, key=lambda entry: entry[0])
+            self.pending[key] = (deadline, callback)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+            elif earliest is None or deadline < earliest[0]:
+                self.cond.notify()
+            return key
+
+    def cancel(self, key):
+        with self.cond:
+            self.pending.pop(key, None)
+
+    def run(self):
+        while True:
+            with self.cond:
+                now = time.time()
+                due = [key for key, (deadline, _) in self.pending.items() if deadline <= now]
+                callbacks = [self.pending.pop(key)[1] for key in due]
+                if not callbacks:
+                    earliest = min((deadline for deadline, _ in self.pending.values()),
+                                   default=None)
+                    self.cond.wait(None if earliest is None else earliest - now)
+            for callback in callbacks:
+                callback()
+
+WATCHDOG = Watchdog()
+
+# Interrupts a response being read in another thread (closing it wouldn't)
+def shutdown_response(resp):
+    try:
+        resp.raw._connection.sock.shutdown(socket.SHUT_RDWR)
+    except (AttributeError, OSError):
+        resp.close()
+
+class PooledTransport(Transport):
+    """Keeps a pool of keep-alive connections per endpoint"""
+
+    def __init__(self, pool_size=10, timeout=30, retries=2, backoff=0.1,
+                 retry_on=(requests.ConnectionError,)):
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.retry_on = retry_on
+        self.sessions = {}
+        self.lock = threading.Lock()
+
+    def session(self, url):
+        with self.lock:
+            if url not in self.sessions:
+                adapter = requests.adapters.HTTPAdapter(
+                    pool_connections=1, pool_maxsize=self.pool_size)
+                session = requests.Session()
+                session.mount(url, adapter)
+                session.headers.update(self.headers)
+                self.sessions[url] = session
+            return self.sessions[url]
+
+    # Only connection errors are retried by default: a request that timed out
+    # may have reached the node (e.g. a personal_sendTransaction). Connecting
+    # and waiting for the response headers share the timeout
+    def send(self, url, data, stream=False):
+        timeout = None if self.timeout is None else urllib3.util.Timeout(total=self.timeout)
+        attempt = 0
+        while True:
+            try:
+                return self.session(url).post(url, data=data, timeout=timeout, stream=stream)
+            except self.retry_on:
+                if attempt == self.retries:
+                    raise
+                Metrics.retry()
+                time.sleep(self.backoff * 2 ** attempt)
+                attempt += 1
+
+    # Socket timeouts apply to each read, so a node trickling the body could
+    # keep a call going indefinitely: its socket is shut down once the whole
+    # timeout is over
+    def post(self, url, data):
+        if self.timeout is None:
+            return super().post(url, data)
+        deadline = time.time() + self.timeout
+        with self.check(self.send(url, data, stream=True)) as resp:
+            expired = []
+            def expire():
+                expired.append(True)
+                shutdown_response(resp)
+            key = WATCHDOG.add(deadline, expire)
+            try:
+                content = resp.content
+            except Exception:
+                if not expired:
+                    raise
+            finally:
+                WATCHDOG.cancel(key)
+            if expired:
+                raise requests.Timeout(f"Response from {url} took more than {self.timeout}s")
+            return content
+
+    def close(self):
+        with self.lock:
+            for session in self.sessions.values():
+                session.close()
+            self.sessions.clear()
+
+# Writes every request/response pair going through `transport` to a JSONL
+# file, with the endpoint url. Streamed responses are recorded once read
+class RecordingTransport(Transport):
+    def __init__(self, transport, path):
+        self.transport = transport
+        self.file = open(path, "w")
+        self.lock = threading.Lock()
+
+    def record(self, url, data, content):
+        line = json.dumps({"url": url, "request": json.loads(data),
+                           "response": json.loads(content)})
+        with self.lock:
+            self.file.write(line + "\n")
+            self.file.flush()
+
+    def post(self, url, data):
+        content = self.transport.post(url, data)
+        self.record(url, data, content)
+        return content
+
+    def post_stream(self, url, data, **kwargs):
+        chunks = []
+        for chunk in self.transport.post_stream(url, data, **kwargs):
+            chunks.append(bytes(chunk))
+            yield chunk
+        self.record(url, data, b"".join(chunks))
+
+# Answers from a recording, matching calls by endpoint, method and params,
+# with the ids rewritten. Calls made several times (e.g. polling) get their
+# recorded responses in order, and the last one once they run out
+class ReplayTransport(Transport):
+    realtime = False
+
+    def __init__(self, path):
+        self.responses = collections.defaultdict(collections.deque)
+        self.lock = threading.Lock()
+        with open(path) as f:
+            for line in f:
+                entry = json.loads(line)
+                requests_, responses = entry["request"], entry["response"]
+                if isinstance(requests_, dict):
+                    requests_, responses = [requests_], [responses]
+                by_id = {response.get("id"): response for response in responses}
+                for req in requests_:
+                    self.responses[self.key(entry["url"], req)].append(by_id.get(req["id"]))
+
+    @staticmethod
+    def key(url, req):
+        return (url, req["method"], json.dumps(req["params"], sort_keys=True))
+
+    def answer(self, url, req):
+        with self.lock:
+            responses = self.responses.get(self.key(url, req))
+            if not responses or responses[0] is None:
+                response = {"error": {"code": -32000, "message": f"{req['method']} not recorded"}}
+            elif len(responses) > 1:
+                response = responses.popleft()
+            else:
+                response = responses[0]
+        return dict(response, id=req["id"])
+
+    def post(self, url, data):
+        req = json.loads(data)
+        if isinstance(req, list):
+            return json.dumps([self.answer(url, r) for r in req]).encode()
+        return json.dumps(self.answer(url, req)).encode()
+
+    def post_stream(self, url, data, **kwargs):
+        yield self.post(url, data)
+
+    # Handler for a StubRPCServer serving the calls recorded for `url`
+    def handler(self, url):
+        def handle(method, params):
+            response = self.answer(url, {"method": method, "params": params, "id": None})
+            if response.get("error"):
+                raise Exception(response["error"]["message"])
+            return response["result"]
+        return handle
+
+
+## Metrics
+
+# One RPC call (or batch, or stream) as seen by a client. `elapsed` covers
+# the whole call, `parse` the part spent decoding the response body
+class CallSample:
+    def __init__(self, client, method, test):
+        self.client = client
+        self.method = method
+        self.test = test
+        self.elapsed = 0
+        self.parse = 0
+        self.sent = 0
+        self.received = 0
+        self.errors = 0
+        self.retries = 0
+
+class MethodStats:
+    # Upper bounds (in seconds) of the latency histogram buckets
+    BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, float("inf"))
+
+    def __init__(self):
+        self.histogram = [0] * len(self.BUCKETS)
+        self.calls = 0
+        self.elapsed = 0
+        self.parse = 0
+        self.sent = 0
+        self.received = 0
+        self.errors = 0
+        self.retries = 0
+
+    def add(self, sample):
+        self.histogram[bisect.bisect_left(self.BUCKETS, sample.elapsed)] += 1
+        self.calls += 1
+        self.elapsed += sample.elapsed
+        self.parse += sample.parse
+        self.sent += sample.sent
+        self.received += sample.received
+        self.errors += sample.errors
+        self.retries += sample.retries
+
+    # Upper bound of the bucket holding the p-th percentile
+    def percentile(self, p):
+        rank = p / 100 * self.calls
+        count = 0
+        for bound, n in zip(self.BUCKETS, self.histogram):
+            count += n
+            if n and count >= rank:
+                return bound
+        return 0
+
+# Per-method call stats, labelled by client (desc) and by the test running
+# in the calling context (see scope()): a context variable rather than a
+# thread local, so coroutines sharing a thread keep their own test. Hooks get every CallSample as it is
+# recorded, and ("wait", client, test, seconds) for the time spent waiting
+# for confirmations, e.g. to send them to an external exporter
+class Metrics:
+    def __init__(self):
+        self.stats = collections.defaultdict(MethodStats)
+        self.waits = collections.defaultdict(float)
+        self.hooks = []
+        self.lock = threading.Lock()
+        self.test = contextvars.ContextVar("test", default=None)
+
+    def add_hook(self, hook):
+        self.hooks.append(hook)
+
+    def current_test(self):
+        return self.test.get()
+
+    @contextlib.contextmanager
+    def scope(self, test):
+        token = self.test.set(test)
+        try:
+            yield
+        finally:
+            self.test.reset(token)
+
+    # Called by the transports before retrying a request, counted in the
+    # call being measured. Shared by all the instances (a transport may be
+    # used by clients with different metrics), and found through a context
+    # variable, which EndpointPool passes on to the threads sending the call
+    measured = contextvars.ContextVar("measured", default=None)
+
+    @classmethod
+    def retry(cls):
+        measured = cls.measured.get()
+        if measured is not None:
+            metrics, sample = measured
+            with metrics.lock: # Hedged requests retry from two threads
+                sample.retries += 1
+
+    @contextlib.contextmanager
+    def measure(self, client, method):
+        sample = CallSample(client, method, self.current_test())
+        token = self.measured.set((self, sample))
+        start = time.time()
+        try:
+            yield sample
+        except Exception:
+            sample.errors = max(sample.errors, 1)
+            raise
+        finally:
+            sample.elapsed = time.time() - start
+            self.measured.reset(token)
+            self.add(sample)
+
+    def add(self, sample):
+        with self.lock:
+            self.stats[(sample.test, sample.client, sample.method)].add(sample)
+        for hook in self.hooks:
+            hook(sample)
+
+    def add_wait(self, client, seconds):
+        test = self.current_test()
+        with self.lock:
+            self.waits[(test, client)] += seconds
+        for hook in self.hooks:
+            hook(("wait", client, test, seconds))
+
+    # Stats merged by (client, method), or by (test, client, method)
+    def totals(self, by_test=False):
+        totals = collections.defaultdict(MethodStats)
+        with self.lock:
+            for (test, client, method), stats in self.stats.items():
+                total = totals[(test, client, method) if by_test else (client, method)]
+                total.histogram = [a + b for a, b in zip(total.histogram, stats.histogram)]
+                for field in ("calls", "elapsed", "parse", "sent", "received", "errors", "retries"):
+                    setattr(total, field, getattr(total, field) + getattr(stats, field))
+        return totals
+
+    def report(self):
+        print(f"\n{'client':<8} {'method':<32} {'calls':>6} {'errors':>6} {'retries':>7} "
+              f"{'total':>8} {'parse':>7} {'p50':>7} {'p95':>7} {'p99':>7} {'sent':>9} {'recv':>9}")
+        for (client, method), stats in sorted(self.totals().items()):
+            print(f"{client:<8} {method:<32} {stats.calls:>6} {stats.errors:>6} {stats.retries:>7} "
+                  f"{stats.elapsed:>7.2f}s {stats.parse:>6.2f}s "
+                  f"{format_bound(stats.percentile(50)):>7} {format_bound(stats.percentile(95)):>7} "
+                  f"{format_bound(stats.percentile(99)):>7} {stats.sent:>9} {stats.received:>9}")
+        waits = collections.defaultdict(float)
+        for (_, client), seconds in self.waits.items():
+            waits[client] += seconds
+        for client, seconds in sorted(waits.items()):
+            print(f"{client:<8} {'(waiting for confirmations)':<32} {seconds:>37.2f}s")
+
+    # Where the time of each test went: RPC calls (node and network), parsing
+    # the responses and waiting for confirmations
+    def report_tests(self, results):
+        totals = self.totals(by_test=True)
+        for test, client, elapsed, _ in results:
+            if client.metrics is not self:
+                continue
+            label = f"{test.__name__} ({client.desc})"
+            calls = {method: stats for (t, c, method), stats in totals.items()
+                     if t == label and c == client.desc}
+            rpc = sum(stats.elapsed for stats in calls.values())
+            parse = sum(stats.parse for stats in calls.values())
+            wait = self.waits.get((label, client.desc), 0)
+            print(f"\n'{test.__name__}' ({client.desc}): {elapsed:.2f}s, rpc {rpc - parse:.2f}s, "
+                  f"parse {parse:.2f}s, waiting {wait:.2f}s, other {max(0, elapsed - rpc - wait):.2f}s")
+            for method, stats in sorted(calls.items(), key=lambda item: -item[1].elapsed):
+                print(f"   {method:<32} {stats.calls:>5} calls {stats.elapsed:>7.2f}s "
+                      f"{stats.sent:>9}B sent {stats.received:>9}B received")
+
+def format_bound(seconds):
+    return "inf" if seconds == float("inf") else f"{seconds * 1000:g}ms"
+
+METRICS = Metrics()
+
+
+## Records
+
+# Addresses are stored as bytes, and the same address is always the same
+# bytes object, however many records refer to it. The table only keeps the
+# most recently seen addresses
+@functools.lru_cache(maxsize=1 << 16)
+def intern_bytes(value):
+    return value
+
+def intern_address(address):
+    if address is None:
+        return None
+    return intern_bytes(bytes.fromhex(remove_0x(address)))
+
+# Data with an odd number of digits (e.g. "0x0" outputs from Geth) is kept
+# as the original string
+def parse_data(data):
+    if data is None or len(data) % 2:
+        return data
+    return bytes.fromhex(remove_0x(data))
+
+def format_data(data):
+    if data is None or isinstance(data, str):
+        return data
+    return prepend_0x(data.hex())
+
+# kind -> (parse from the JSON-RPC value, format back to it)
+RECORD_KINDS = {
+    "address": (intern_address, format_data),
+    "hash": (parse_data, format_data),
+    "data": (parse_data, format_data),
+    "topics": (lambda topics: tuple(map(parse_data, topics)),
+               lambda topics: list(map(format_data, topics))),
+    # Parsed on first access, see Record.__getattr__
+    "quantity": (lambda value: value, lambda value: hex(value) if isinstance(value, int) else value),
+    "path": (tuple, list),
+    "logs": (lambda logs: [Log(log) for log in logs], lambda logs: [log.to_dict() for log in logs]),
+    "raw": (lambda value: value, lambda value: value),
+}
+
+# Compact, slotted view of a JSON-RPC result. FIELDS lists (key, slot, kind,
+# optional): optional fields missing in the original are left out of
+# to_dict(). Items can still be read with the original keys and format
+# (record["from"] is a hex string), quantities as ints by attribute
+# (record.gas_used, from the "_gas_used" slot). Keys not in FIELDS (e.g.
+# blobGasUsed, or the L1 fees of rollups) are kept as they are in _extra
+class Record:
+    __slots__ = ("_extra",)
+    FIELDS = ()
+    KEYS = frozenset()
+
+    def __init__(self, values):
+        for key, slot, kind, _ in self.FIELDS:
+            setattr(self, slot, RECORD_KINDS[kind][0](values.get(key)) if key in values else None)
+        extra = {key: value for key, value in values.items() if key not in self.KEYS}
+        self._extra = extra or None
+
+    def __init_subclass__(cls):
+        super().__init_subclass__()
+        cls.KEYS = frozenset(key for key, _, _, _ in cls.FIELDS)
+
+    # The int replaces the string only when it formats back to it, so items
+    # keep the original value (e.g. "0x00")
+    def __getattr__(self, name):
+        value = object.__getattribute__(self, "_" + name)
+        if isinstance(value, str):
+            string, value = value, int(value, 16)
+            if hex(value) == string:
+                setattr(self, "_" + name, value)
+        return value
+
+    @classmethod
+    def field(cls, key):
+        for field in cls.FIELDS:
+            if field[0] == key:
+                return field
+        raise KeyError(key)
+
+    def __getitem__(self, key):
+        if key not in self.KEYS and self._extra is not None and key in self._extra:
+            return self._extra[key]
+        _, slot, kind, _ = self.field(key)
+        value = object.__getattribute__(self, slot)
+        return None if value is None else RECORD_KINDS[kind][1](value)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def keys(self):
+        return [key for key, _, _, _ in self.FIELDS] + list(self._extra or ())
+
+    def __contains__(self, key):
+        return key in self.keys()
+
+    def to_dict(self):
+        values = {key: self[key] for key, slot, _, optional in self.FIELDS
+                  if not optional or object.__getattribute__(self, slot) is not None}
+        if self._extra is not None:
+            values.update(self._extra)
+        return values
+
+    # Equal to a record of the same type, or to a JSON-RPC result, with the
+    # same values
+    def __eq__(self, other):
+        if isinstance(other, Record):
+            return type(self) is type(other) and self.to_dict() == other.to_dict()
+        if isinstance(other, dict):
+            return self.to_dict() == other
+        return NotImplemented
+
+    __hash__ = None
+
+    def __repr__(self):
+        return f"{type(self).__name__}({self.to_dict()!r})"
+
+class TraceFrame(Record):
+    FIELDS = (
+        ("type", "type", "raw", False),
+        ("from", "from_", "address", False),
+        ("to", "to", "address", False),
+        ("value", "_value", "quantity", False),
+        ("gas", "_gas", "quantity", False),
+        ("gasUsed", "_gas_used", "quantity", False),
+        ("input", "input", "data", False),
+        ("output", "output", "data", False),
+        ("error", "error", "raw", False),
+        ("depth", "depth", "raw", False),
+        ("traceAddress", "trace_address", "path", False),
+    )
+    __slots__ = tuple(slot for _, slot, _, _ in FIELDS)
+
+class Log(Record):
+    FIELDS = (
+        ("address", "address", "address", False),
+        ("topics", "topics", "topics", False),
+        ("data", "data", "data", False),
+        ("blockHash", "block_hash", "hash", False),
+        ("blockNumber", "_block_number", "quantity", False),
+        ("transactionHash", "transaction_hash", "hash", False),
+        ("transactionIndex", "_transaction_index", "quantity", False),
+        ("logIndex", "_log_index", "quantity", False),
+        ("transactionLogIndex", "_transaction_log_index", "quantity", True), # OpenEthereum
+        ("type", "type", "raw", True), # OpenEthereum
+        ("removed", "removed", "raw", True),
+    )
+    __slots__ = tuple(slot for _, slot, _, _ in FIELDS)
+
+class Receipt(Record):
+    FIELDS = (
+        ("transactionHash", "transaction_hash", "hash", False),
+        ("transactionIndex", "_transaction_index", "quantity", False),
+        ("blockHash", "block_hash", "hash", False),
+        ("blockNumber", "_block_number", "quantity", False),
+        ("from", "from_", "address", False),
+        ("to", "to", "address", False),
+        ("cumulativeGasUsed", "_cumulative_gas_used", "quantity", False),
+        ("gasUsed", "_gas_used", "quantity", False),
+        ("contractAddress", "contract_address", "address", False),
+        ("logs", "logs", "logs", False),
+        ("logsBloom", "logs_bloom", "data", False),
+        ("status", "_status", "quantity", False),
+        ("root", "root", "hash", True),
+        ("type", "_type", "quantity", True),
+        ("effectiveGasPrice", "_effective_gas_price", "quantity", True),
+    )
+    __slots__ = tuple(slot for _, slot, _, _ in FIELDS)
+
 
 ## Client
 
-class RPCRequest:
-    def __init__(self, host, port, method, params):
-        self.host = host
-        self.port = port
-        self.method = method
-        self.params = params
+class RPCError(Exception):
+    def __init__(self, error):
+        super().__init__(error)
+        self.error = error
+
+# A null result, e.g. for an unknown tx
+class NullResult(Exception):
+    def __init__(self):
+        super().__init__("null result")
+
+class RPCRequest:
+    def __init__(self, host, port, method, params, transport=None, id_=1):
+        self.host = host
+        self.port = port
+        self.method = method
+        self.params = params
+        self.transport = transport or SimpleTransport()
+        self.id = id_
+
+    def get_data(self):
+        return {
+            "jsonrpc" : "2.0",
+            "method" : self.method,
+            "params" : self.params,
+            "id": self.id
+        }
+
+    def get_url(self):
+        return "http://%s:%s" % (self.host, self.port)
+
+    # Fills in the sizes and the parsing time of `sample` when given
+    def execute(self, sample=None):
+        data = json.dumps(self.get_data())
+        content = self.transport.post(self.get_url(), data)
+        start = time.time()
+        body = json.loads(content)
+        if sample is not None:
+            sample.sent, sample.received = len(data), len(content)
+            sample.parse = time.time() - start
+
+        return self.parse(body)
+
+    @staticmethod
+    def parse(body):
+        if body.get("error"):
+            raise RPCError(body['error'])
+
+        if body["result"] is None:
+            raise NullResult()
+
+        return body["result"]
+
+    def as_curl(self):
+        return (f"curl -X POST " + 
+                f"--data '{json.dumps(self.get_data())}' " +
+                f"--header 'Content-Type: application/json' " +
+                f"http://{self.host}:{self.port}")
+
+# Several requests sent in a single POST. Responses may come back in any
+# order, so they are matched by id
+class RPCBatch(RPCRequest):
+    def __init__(self, host, port, requests_, transport=None):
+        super().__init__(host, port, None, None, transport)
+        self.requests = requests_
+
+    def get_data(self):
+        return [req.get_data() for req in self.requests]
+
+    def execute(self, sample=None):
+        data = json.dumps(self.get_data())
+        content = self.transport.post(self.get_url(), data)
+        start = time.time()
+        body = json.loads(content)
+        if sample is not None:
+            sample.sent, sample.received = len(data), len(content)
+            sample.parse = time.time() - start
+
+        if isinstance(body, dict): # The whole batch was rejected
+            raise RPCError(body.get("error", body))
+
+        by_id = {resp.get("id"): resp for resp in body}
+        missing = {"error": {"code": -32603, "message": "missing response"}}
+        return [by_id.get(req.id, missing) for req in self.requests]
+
+class BatchCall:
+    def __init__(self, method, params, parse):
+        self.method = method
+        self.params = params
+        self.parse = parse
+        self.value = None
+
+    def result(self):
+        if isinstance(self.value, Exception):
+            raise self.value
+        return self.parse(self.value)
+
+class Batch:
+    """Collects calls and sends them in one round trip when the context exits"""
+
+    def __init__(self, client):
+        self.client = client
+        self.calls = []
+
+    def add(self, method, params, parse=lambda result: result):
+        call = BatchCall(method, params, parse)
+        self.calls.append(call)
+        return call
+
+    def eth_getTransactionByHash(self, txhash):
+        return self.add("eth_getTransactionByHash", [txhash])
+
+    def eth_getTransactionReceipt(self, txhash):
+        return self.add("eth_getTransactionReceipt", [txhash], Receipt)
+
+    def eth_call(self, to_, data, at_):
+        return self.add("eth_call", [{"to": to_, "data": data}, at_])
+
+    def trace_transaction(self, txhash):
+        method, params = self.client.trace_request(txhash)
+        return self.add(method, params, self.client.parse_trace)
+
+    def execute(self):
+        results = self.client.call_many(
+            [(call.method, call.params) for call in self.calls],
+            return_exceptions=True)
+        for call, result in zip(self.calls, results):
+            call.value = result
+        self.calls = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *args):
+        if exc_type is None:
+            self.execute()
+
+# Incremental JSON parser over a stream of byte chunks. items(path) walks
+# down the keys in `path` and yields the elements of the array found there
+# one at a time, keeping only the element being decoded in memory
+class JSONStream:
+    whitespace = " \t\r\n"
+    delimiters = whitespace + ",:]}"
+
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.decoder = codecs.getincrementaldecoder("utf-8")()
+        self.json = json.JSONDecoder()
+        self.buf = ""
+        self.pos = 0
+        self.eof = False
+
+    def fill(self):
+        chunk = next(self.chunks, None)
+        self.buf = self.buf[self.pos:] + self.decoder.decode(chunk or b"", final=chunk is None)
+        self.pos = 0
+        self.eof = chunk is None
+        return not self.eof
+
+    def peek(self):
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in self.whitespace:
+                self.pos += 1
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self.fill():
+                return None
+
+    def expect(self, chars):
+        char = self.peek()
+        if char is None or char not in chars:
+            raise ValueError(f"Expected {chars!r} at {self.pos}, found {char!r}")
+        self.pos += 1
+        return char
+
+    # Decodes the value at the current position, reading more chunks until
+    # it is complete. A value must be followed by a delimiter, otherwise it
+    # may be a truncated number. The buffer is at least doubled before
+    # retrying, to keep this linear
+    def value(self):
+        self.peek()
+        while True:
+            try:
+                value, end = self.json.raw_decode(self.buf, self.pos)
+                if self.eof or (end < len(self.buf) and self.buf[end] in self.delimiters):
+                    self.pos = end
+                    return value
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            target = 2 * (len(self.buf) - self.pos)
+            while self.fill() and len(self.buf) - self.pos < target:
+                pass
+
+    def items(self, path):
+        for key in path:
+            self.expect("{")
+            while True:
+                name = self.value()
+                self.expect(":")
+                if name == key:
+                    break
+                value = self.value()
+                if name == "error" and value:
+                    raise RPCError(value)
+                if self.expect(",}") == "}":
+                    raise KeyError(key)
+
+        if self.peek() != "[":
+            value = self.value()
+            if value is None:
+                raise NullResult()
+            yield value
+            return
+
+        self.expect("[")
+        if self.peek() == "]":
+            return
+        while True:
+            yield self.value()
+            if self.expect(",]") == "]":
+                return
+
+# See https://eth.wiki/json-rpc/API
+class Client:
+    desc = "Client"
+
+    def __init__(self, host, port, verbose, transport=None, cache=None, metrics=None):
+        self.host = host
+        self.port = port
+        self.verbose = verbose
+        self.transport = transport or PooledTransport()
+        self.cache = cache
+        self.metrics = metrics or METRICS
+        self.account = None
+        self.confirmations = ConfirmationWatcher(self)
+
+    # Copy of the client whose default account is `account` (the copies
+    # share the transport, cache and confirmation watcher)
+    def for_account(self, account):
+        client = copy.copy(self)
+        client.account = account
+        return client
+
+    def default_account(self):
+        return self.account or self.eth_accounts()[0]
+
+    def cache_key(self, method, params):
+        if self.cache is None:
+            return None
+        return self.cache.key(f"{self.host}:{self.port}", method, params)
+
+    def __call(self, method, params):
+        key = self.cache_key(method, params)
+        res = self.cache.get(key) if key else None
+        if res is not None:
+            return res
+        req = RPCRequest(self.host, self.port, method, params, self.transport)
+        if self.verbose:
+            print(">>", req.as_curl())
+        with self.metrics.measure(self.desc, method) as sample:
+            res = req.execute(sample)
+        if self.verbose:
+            print("<<", dumps(res))
+        if key:
+            self.cache.put(key, method, res)
+        return res
+
+    def _call(self, method, params):
+        return self.__call(method, params)
+
+    # Sends all the (method, params) calls in a single request. Results are
+    # returned in the same order; with return_exceptions=True failed calls
+    # return their exception instead of raising it (as in asyncio.gather)
+    def call_many(self, calls, return_exceptions=False):
+        keys = [self.cache_key(method, params) for method, params in calls]
+        results = [self.cache.get(key) if key else None for key in keys]
+        missing = [i for i, result in enumerate(results) if result is None]
+        if not missing:
+            return results
+        batch = RPCBatch(self.host, self.port, [
+            RPCRequest(self.host, self.port, *calls[i], id_=i) for i in missing
+        ], self.transport)
+        if self.verbose:
+            print(">>", batch.as_curl())
+        methods = sorted({calls[i][0] for i in missing})
+        with self.metrics.measure(self.desc, f"batch[{','.join(methods)}]") as sample:
+            bodies = batch.execute(sample)
+            sample.errors = sum(1 for body in bodies if body.get("error"))
+        for i, body in zip(missing, bodies):
+            try:
+                results[i] = RPCRequest.parse(body)
+                if keys[i]:
+                    self.cache.put(keys[i], calls[i][0], results[i])
+            except Exception as e:
+                if not return_exceptions:
+                    raise
+                results[i] = e
+        if self.verbose:
+            print("<<", dumps([r if not isinstance(r, Exception) else str(r) for r in results]))
+        return results
+
+    def batch(self):
+        return Batch(self)
+
+    # Yields the items of the array at `path` in the response (trace frames,
+    # logs, struct logs...) as the body is read, instead of loading it whole
+    def stream(self, method, params, path=("result",), spool_threshold=None):
+        req = RPCRequest(self.host, self.port, method, params)
+        if self.verbose:
+            print(">>", req.as_curl())
+        data = json.dumps(req.get_data())
+        chunks = self.transport.post_stream(req.get_url(), data, spool_threshold=spool_threshold)
+        return JSONStream(self.measure_stream(method, data, chunks)).items(path)
+
+    # Streamed calls are measured until the whole body has been read
+    def measure_stream(self, method, data, chunks):
+        with self.metrics.measure(self.desc, method) as sample:
+            sample.sent = len(data)
+            for chunk in chunks:
+                sample.received += len(chunk)
+                yield chunk
+
+    def eth_accounts(self):
+        return self.__call("eth_accounts", [])
+
+    def personal_sendTransaction(self, from_, to_, value_, nonce, gas, gasPrice, data):
+        req = {
+            "from": from_,
+            "to": to_,
+            "value": hex(value_),
+            "nonce": hex(nonce),
+            "gas": hex(gas),
+            "gasPrice": hex(gasPrice),
+            "data": data
+        }
+        return self.__call("personal_sendTransaction", [req, ""])
+
+    def eth_call(self, to_, data, at_):
+        req = {
+            "to": to_,
+            "data": data
+        }
+        return self.__call("eth_call", [req, at_])
+
+    def eth_blockNumber(self):
+        return self.__call("eth_blockNumber", [])
+
+    def eth_getTransactionCount(self, address, block="pending"):
+        return self.__call("eth_getTransactionCount", [address, block])
+
+    def eth_getTransactionByHash(self, txhash):
+        return self.__call("eth_getTransactionByHash", [txhash])
+
+    def eth_getTransactionReceipt(self, txhash):
+        return Receipt(self.__call("eth_getTransactionReceipt", [txhash]))
+
+    def eth_getLogs(self, address, fromBlock, toBlock, topics):
+        req = {
+            "address": address,
+            "fromBlock": fromBlock,
+            "toBlock": toBlock,
+            "topics": topics
+        }
+        return self.__call("eth_getLogs", [req])
+
+    def trace_request(self, txhash):
+        raise NotImplementedError()
+
+    def parse_trace(self, result):
+        raise NotImplementedError()
+
+    def trace_transaction(self, txhash):
+        return self.parse_trace(self._call(*self.trace_request(txhash)))
+
+class OpenEthereumClient(Client):
+    desc = "OpenEth"
+
+    @classmethod
+    def normalize(cls, trace):
+        result = trace.get("result") or {}
+        return TraceFrame({
+          "type": trace["action"]["callType"] if trace["type"] == "call" else trace["type"],
+          "from": trace["action"]["from"],
+          "to": trace["action"].get("to", result.get("address")), # Not present on creations
+          "value": trace["action"]["value"],
+          "gas": trace["action"]["gas"],
+          "gasUsed": result.get("gasUsed"),
+          "input": trace["action"].get("input", trace["action"].get("init")),
+          "output": result.get("output"),
+          "error": trace.get("error"),
+          "depth": len(trace["traceAddress"]),
+          "traceAddress": trace["traceAddress"]
+        })
+
+    # https://openethereum.github.io/JSONRPC-trace-module
+    def trace_request(self, txhash):
+        return "trace_transaction", [txhash]
+
+    def parse_trace(self, traces):
+        return list(map(self.normalize, traces))
+
+    # Gas per opcode and call frame, from a vmTrace replay of the tx
+    def profile_gas(self, txhash, spool_threshold=None):
+        tx = self.eth_getTransactionByHash(txhash)
+        if tx["to"] is None:
+            root, code = "new contract", tx["input"]
+        else:
+            root, code = tx["to"], self._call("eth_getCode", [tx["to"], tx["blockNumber"]])
+        ops = self.stream("trace_replayTransaction", [txhash, ["vmTrace"]],
+                          ("result", "vmTrace", "ops"), spool_threshold)
+        return profile_vm_trace(ops, bytes.fromhex(remove_0x(code)), root)
+
+    # (tx position, normalized frame) for all the txs in a block, streamed.
+    # Block rewards and self-destructs are skipped
+    def iter_trace_block(self, block, spool_threshold=None):
+        for trace in self.stream("trace_block", [block], spool_threshold=spool_threshold):
+            if trace["type"] in ("call", "create"):
+                yield trace["transactionPosition"], self.normalize(trace)
+
+
+class GethClient(Client):
+    desc = "Geth"
+
+    @classmethod
+    def frame(cls, trace, trace_address):
+        return TraceFrame({
+          "type": trace["type"].lower(),
+          "from": trace["from"],
+          "to": trace["to"],
+          "value": trace.get("value", "0x0"), # Not present on delegate calls
+          "gas": trace["gas"],
+          "gasUsed": trace["gasUsed"],
+          "input": trace["input"],
+          "output": trace.get("output"),
+          "error": trace.get("error"),
+          "depth": len(trace_address),
+          "traceAddress": trace_address
+        })
+
+    # Yields the frames in pre-order, keeping an explicit stack of the
+    # pending subcalls per level, so memory is bounded by the depth of the
+    # tree and deep traces don't hit the recursion limit. The trace address
+    # is a single list, pushed and popped along the walk (each frame keeps
+    # its own tuple of it)
+    @classmethod
+    def iter_frames(cls, trace):
+        address = []
+        yield cls.frame(trace, address)
+        stack = [enumerate(trace.get("calls", []))]
+        while stack:
+            for index, call in stack[-1]:
+                address.append(index)
+                yield cls.frame(call, address)
+                stack.append(enumerate(call.get("calls", [])))
+                break
+            else:
+                stack.pop()
+                if stack:
+                    address.pop()
+
+    @classmethod
+    def flatten(cls, trace):
+        return list(cls.iter_frames(trace))
+
+    # https://geth.ethereum.org/docs/dapp/tracing
+    # https://geth.ethereum.org/docs/rpc/ns-debug#debug_tracetransaction
+    def trace_request(self, txhash):
+        return "debug_traceTransaction", [txhash, {"tracer": "callTracer"}]
+
+    def parse_trace(self, trace):
+        return self.flatten(trace)
+
+    # (tx position, frame) for all the txs in a block, streamed
+    def iter_trace_block(self, block, spool_threshold=None):
+        traces = self.stream("debug_traceBlockByNumber", [block, {"tracer": "callTracer"}],
+                             spool_threshold=spool_threshold)
+        for position, trace in enumerate(traces):
+            if "error" in trace:
+                raise RPCError(trace["error"])
+            for frame in self.iter_frames(trace["result"]):
+                yield position, frame
+
+    # Gas per opcode and call frame, from the struct logs of the tx
+    def profile_gas(self, txhash, spool_threshold=None):
+        tx = self.eth_getTransactionByHash(txhash)
+        steps = self.iter_struct_logs(txhash, spool_threshold=spool_threshold)
+        return profile_struct_logs(steps, tx["to"] or "new contract")
+
+    # Steps of the default struct logger, streamed
+    def iter_struct_logs(self, txhash, options=None, spool_threshold=None):
+        if options is None:
+            options = {"disableStorage": True, "disableMemory": True}
+        return self.stream("debug_traceTransaction", [txhash, options],
+                           ("result", "structLogs"), spool_threshold)
+
+
+## Endpoint pool
+
+# Calls whose answer is the same on any node following the chain, so they
+# can be spread over the pool and hedged. Everything else (sending txs,
+# filters, nonces) goes to the first node, which holds the accounts
+POOL_READ_METHODS = {
+    "eth_call", "eth_getLogs", "eth_getBalance", "eth_getCode",
+    "eth_getTransactionByHash", "eth_getTransactionReceipt",
+    "trace_transaction", "trace_block", "trace_replayTransaction",
+    "debug_traceTransaction", "debug_traceBlockByNumber",
+}
+
+# Position of the block parameter of the reads taking one ("latest" when
+# left out). eth_getLogs has it in its filter
+BLOCK_PARAMS = {
+    "eth_call": 1, "eth_getBalance": 1, "eth_getCode": 1,
+    "trace_block": 0, "debug_traceBlockByNumber": 0,
+}
+
+def block_tag(req):
+    params = req.get("params", [])
+    if req["method"] == "eth_getLogs":
+        filter_ = params[0] if params else {}
+        return None if "blockHash" in filter_ else filter_.get("toBlock", "latest")
+    if req["method"] in BLOCK_PARAMS:
+        position = BLOCK_PARAMS[req["method"]]
+        return params[position] if len(params) > position else "latest"
+    return None
+
+NULL_RESULT_RE = re.compile(rb'"result": ?null')
+
+# Whether the response (or any response of a batch) has a null result. Nested
+# nulls (e.g. in traces) are common, so the regex only spares parsing bodies
+# that have none at all
+def has_null_result(content):
+    if not NULL_RESULT_RE.search(content):
+        return False
+    try:
+        resp = json.loads(content)
+    except ValueError:
+        return False
+    resps = resp if isinstance(resp, list) else [resp]
+    return any(isinstance(r, dict) and "result" in r and r["result"] is None for r in resps)
+
+class Endpoint:
+    def __init__(self, client, window):
+        self.client = client
+        self.url = RPCRequest(client.host, client.port, None, None).get_url()
+        self.latency = None # EWMA, in seconds
+        self.latencies = collections.deque(maxlen=window)
+        self.inflight = 0
+        self.head = None
+        self.failures = 0
+        self.healthy = True
+        self.reason = None
+        self.probing = False
+        self.requests = 0
+        self.errors = 0
+        self.hedges = 0 # Hedged requests it answered before the first node tried
+
+    def observe(self, elapsed, decay):
+        self.latency = elapsed if self.latency is None else \
+            decay * elapsed + (1 - decay) * self.latency
+        self.latencies.append(elapsed)
+
+    # Expected wait of a new request, counting the ones already in flight
+    def score(self):
+        return (self.latency or 0) * (self.inflight + 1)
+
+# Transport spreading the read calls of a client over several nodes of the
+# same kind, picking the one with the lowest EWMA latency times the calls
+# in flight. A background thread polls eth_blockNumber on every node, and
+# ejects the ones failing `max_failures` times in a row (probes or calls)
+# or lagging more than `max_lag` blocks behind the best head, until they
+# catch up. With hedge=True a read still running past the p95 latency of
+# its node is sent again to the next best node, and the first answer wins.
+# Reads of the "latest" or "pending" state also go to the first node, which
+# has seen the txs just sent; with balance_head=True "latest" reads go to
+# the nodes that were at the best head on the last probe (which may still
+# be a block behind right after a tx is mined).
+# Use client() to get a client of the same kind going through the pool
+class EndpointPool(Transport):
+    def __init__(self, clients, probe_interval=1.0, max_failures=3, max_lag=2, hedge=False,
+                 hedge_min=0.005, hedge_samples=20, decay=0.3, window=200, workers=64,
+                 balance_head=False):
+        self.endpoints = [Endpoint(client, window) for client in clients]
+        self.primary = self.endpoints[0]
+        self.realtime = all(client.transport.realtime for client in clients)
+        self.max_failures = max_failures
+        self.max_lag = max_lag
+        self.hedge = hedge
+        self.balance_head = balance_head
+        self.best = None
+        self.hedge_min = hedge_min
+        self.hedge_samples = hedge_samples
+        self.decay = decay
+        self.lock = threading.Lock()
+        self.executor = concurrent.futures.ThreadPoolExecutor(workers)
+        self.prober = concurrent.futures.ThreadPoolExecutor(len(self.endpoints))
+        self.stopped = threading.Event()
+        if probe_interval:
+            self.probe()
+            threading.Thread(target=self.run, args=(probe_interval,), daemon=True).start()
+
+    def client(self):
+        client = copy.copy(self.primary.client)
+        client.transport = self
+        client.confirmations = ConfirmationWatcher(client)
+        return client
+
+    def run(self, interval):
+        while not self.stopped.wait(interval):
+            self.probe()
+
+    # Probes also refresh the latency of the endpoints not being picked
+    def probe_endpoint(self, endpoint):
+        start = time.time()
+        try:
+            endpoint.head = int(endpoint.client.eth_blockNumber(), 16)
+            with self.lock:
+                endpoint.failures = 0
+                endpoint.observe(time.time() - start, self.decay)
+        except Exception as e:
+            with self.lock:
+                endpoint.failures += 1
+                endpoint.reason = str(e)
+        finally:
+            endpoint.probing = False
+
+    # A probe still running from the previous round counts as a failure
+    def probe(self):
+        futures = []
+        for endpoint in self.endpoints:
+            if endpoint.probing:
+                with self.lock:
+                    endpoint.failures += 1
+                    endpoint.reason = "probe timed out"
+            else:
+                endpoint.probing = True
+                futures.append(self.prober.submit(self.probe_endpoint, endpoint))
+        concurrent.futures.wait(futures, timeout=1)
+        with self.lock:
+            heads = [e.head for e in self.endpoints if e.head is not None and not e.failures]
+            best = self.best = max(heads, default=None)
+            for endpoint in self.endpoints:
+                if endpoint.failures >= self.max_failures:
+                    endpoint.healthy = False
+                elif endpoint.head is None:
+                    endpoint.healthy, endpoint.reason = False, "no head"
+                elif best is not None and best - endpoint.head > self.max_lag:
+                    endpoint.healthy = False
+                    endpoint.reason = f"{best - endpoint.head} blocks behind"
+                else:
+                    endpoint.healthy, endpoint.reason = True, None
+
+    # Lowest score among the healthy endpoints (among all of them if none
+    # is). With at_head, among the healthy ones at the best head, else the
+    # first node
+    def pick(self, exclude=None, at_head=False):
+        with self.lock:
+            candidates = [e for e in self.endpoints if e is not exclude]
+            healthy = [e for e in candidates if e.healthy and (not at_head or e.head == self.best)]
+            if at_head and not healthy:
+                return self.primary if self.primary is not exclude else None
+            return min(healthy or candidates, key=Endpoint.score, default=None)
+
+    # None for the calls that must go to the first node, else whether they
+    # read the state at the head
+    def route(self, data):
+        req = json.loads(data)
+        reqs = req if isinstance(req, list) else [req]
+        if any(r["method"] not in POOL_READ_METHODS for r in reqs):
+            return None
+        tags = {block_tag(r) for r in reqs}
+        if "pending" in tags or ("latest" in tags and not self.balance_head):
+            return None
+        return "latest" in tags
+
+    def send_to(self, endpoint, data):
+        with self.lock:
+            endpoint.inflight += 1
+            endpoint.requests += 1
+        start = time.time()
+        try:
+            content = endpoint.client.transport.post(endpoint.url, data)
+        except Exception as e: # Counts in the latency too, e.g. a timeout
+            with self.lock:
+                endpoint.inflight -= 1
+                endpoint.observe(time.time() - start, self.decay)
+                endpoint.errors += 1
+                endpoint.failures += 1
+                if endpoint.failures >= self.max_failures:
+                    endpoint.healthy, endpoint.reason = False, str(e)
+            raise
+        with self.lock:
+            endpoint.inflight -= 1
+            endpoint.failures = 0
+            endpoint.observe(time.time() - start, self.decay)
+        return content
+
+    def hedge_delay(self, endpoint):
+        with self.lock:
+            if len(endpoint.latencies) < self.hedge_samples:
+                return None
+            latencies = list(endpoint.latencies)
+        return max(self.hedge_min, percentile(latencies, 95))
+
+    # Runs the call on `endpoint` and, if it takes longer than its p95 (or
+    # fails), on the next best endpoint too. The slower call is left to
+    # finish in the background, so its latency still counts
+    def send_hedged(self, endpoint, data, at_head=False):
+        first = self.executor.submit(contextvars.copy_context().run, self.send_to, endpoint, data)
+        try:
+            return first.result(timeout=self.hedge_delay(endpoint))
+        except concurrent.futures.TimeoutError:
+            pass
+        except Exception:
+            pass
+        other = self.pick(endpoint, at_head)
+        if other is None:
+            return first.result()
+        second = self.executor.submit(contextvars.copy_context().run, self.send_to, other, data)
+        error = None
+        for future in concurrent.futures.as_completed([first, second]):
+            try:
+                content = future.result()
+            except Exception as e:
+                error = e
+                continue
+            if future is second:
+                with self.lock:
+                    other.hedges += 1
+            return content
+        raise error
+
+    def post(self, url, data):
+        at_head = self.route(data)
+        if at_head is None:
+            return self.send_to(self.primary, data)
+        endpoint = self.pick(at_head=at_head)
+        if self.hedge:
+            content = self.send_hedged(endpoint, data, at_head)
+        else:
+            try:
+                content = self.send_to(endpoint, data)
+            except Exception:
+                other = self.pick(endpoint, at_head)
+                if other is None:
+                    raise
+                content = self.send_to(other, data)
+        # A node a block behind may not have a receipt or tx yet
+        if endpoint is not self.primary and has_null_result(content):
+            return self.send_to(self.primary, data)
+        return content
+
+    # Streams are balanced but not hedged
+    def post_stream(self, url, data, **kwargs):
+        at_head = self.route(data)
+        endpoint = self.primary if at_head is None else self.pick(at_head=at_head)
+        with self.lock:
+            endpoint.inflight += 1
+            endpoint.requests += 1
+        try:
+            yield from endpoint.client.transport.post_stream(endpoint.url, data, **kwargs)
+        finally:
+            with self.lock:
+                endpoint.inflight -= 1
+
+    def report(self):
+        for e in self.endpoints:
+            state = "healthy" if e.healthy else f"ejected ({e.reason})"
+            latency = f"{e.latency * 1000:.2f}ms" if e.latency is not None else "-"
+            print(f" - {e.url}: {state}, head {e.head}, latency {latency}, "
+                  f"{e.requests} requests, {e.errors} errors, {e.hedges} hedges won")
+
+    def close(self):
+        self.stopped.set()
+        self.executor.shutdown(wait=False)
+        self.prober.shutdown(wait=False)
+
+
+## Cache
+
+def is_fixed_block(block):
+    if isinstance(block, dict): # EIP-1898
+        return "blockHash" in block or is_fixed_block(block.get("blockNumber"))
+    return isinstance(block, str) and block.startswith("0x")
+
+# Results that can't change once their tx or block is mined: method ->
+# (request is cacheable, result is cacheable). Block tags (latest, pending...)
+# are never cached
+CACHEABLE_METHODS = {
+    "eth_getTransactionReceipt": (lambda params: True, lambda result: result.get("blockHash")),
+    "eth_getTransactionByHash": (lambda params: True, lambda result: result.get("blockHash")),
+    "trace_transaction": (lambda params: True, lambda result: True),
+    "trace_replayTransaction": (lambda params: True, lambda result: True),
+    "debug_traceTransaction": (lambda params: True, lambda result: True),
+    "eth_getBlockByHash": (lambda params: True, lambda result: True),
+    "eth_getBlockByNumber": (lambda params: is_fixed_block(params[0]), lambda result: True),
+    "trace_block": (lambda params: is_fixed_block(params[0]), lambda result: True),
+    "debug_traceBlockByNumber": (lambda params: is_fixed_block(params[0]), lambda result: True),
+    "eth_call": (lambda params: is_fixed_block(params[1]), lambda result: True),
+    "eth_getBalance": (lambda params: is_fixed_block(params[1]), lambda result: True),
+    "eth_getCode": (lambda params: is_fixed_block(params[1]), lambda result: True),
+    "eth_getStorageAt": (lambda params: is_fixed_block(params[2]), lambda result: True),
+}
+
+# LRU of immutable results, bounded by the size of their JSON encoding, and
+# optionally persisted to a SQLite file shared between runs
+class RPCCache:
+    def __init__(self, max_bytes=64 << 20, path=None):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.db = None
+        if path:
+            self.db = sqlite3.connect(path, check_same_thread=False)
+            self.db.execute("CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, value TEXT)")
+
+    @staticmethod
+    def key(endpoint, method, params):
+        if method not in CACHEABLE_METHODS or not CACHEABLE_METHODS[method][0](params):
+            return None
+        return json.dumps([endpoint, method, params], sort_keys=True)
+
+    def get(self, key):
+        with self.lock:
+            value = self.entries.get(key)
+            if value is not None:
+                self.entries.move_to_end(key)
+            elif self.db:
+                row = self.db.execute("SELECT value FROM results WHERE key = ?", (key,)).fetchone()
+                if row is None:
+                    return None
+                value = row[0]
+                self.insert(key, value)
+            else:
+                return None
+        return json.loads(value)
+
+    def put(self, key, method, result):
+        if not CACHEABLE_METHODS[method][1](result):
+            return
+        value = json.dumps(result)
+        with self.lock:
+            self.insert(key, value)
+            if self.db:
+                self.db.execute("INSERT OR REPLACE INTO results VALUES (?, ?)", (key, value))
+                self.db.commit()
+
+    def insert(self, key, value):
+        if key in self.entries:
+            self.size -= len(self.entries.pop(key))
+        if len(value) > self.max_bytes:
+            return
+        self.entries[key] = value
+        self.size += len(value)
+        while self.size > self.max_bytes:
+            self.size -= len(self.entries.popitem(last=False)[1])
+
+
+## Log scanner
+
+# Substrings of the errors nodes return when a range has too many logs or
+# takes too long (e.g. "query returned more than 10000 results")
+LOG_RANGE_ERRORS = (
+    "returned more than", "too many results", "response size exceeded", "block range",
+    "range too large", "range is too large", "query timeout",
+)
+
+# And when they throttle the client, whatever the range
+RATE_LIMIT_ERRORS = ("rate limit", "too many requests", "requests per second", "429")
+
+def is_rate_limit_error(e):
+    return any(hint in str(e).lower() for hint in RATE_LIMIT_ERRORS)
+
+def is_log_range_error(e):
+    if is_rate_limit_error(e):
+        return False
+    return (isinstance(e, requests.Timeout) or
+            any(hint in str(e).lower() for hint in LOG_RANGE_ERRORS))
+
+# Scans a block range with eth_getLogs in windows fetched concurrently,
+# yielding the logs in block order. A window the node rejects as too big is
+# bisected; the window size shrinks when results are dense and grows when
+# they are sparse. A window the node rejects because of a rate limit is
+# sent again after a backoff, up to `retries` times in a row. With `checkpoint`, the last block fully consumed is
+# saved to that file, and a later scan resumes after it
+class LogScanner:
+    def __init__(self, client, address, topics, window=1000, min_window=1,
+                 max_window=100000, target=1000, workers=4, checkpoint=None,
+                 retries=5, backoff=0.5):
+        self.client = client
+        self.address = address
+        self.topics = topics
+        self.window = window
+        self.min_window = min_window
+        self.max_window = max_window
+        self.target = target
+        self.workers = workers
+        self.checkpoint = checkpoint
+        self.retries = retries
+        self.backoff = backoff
+
+    def fetch(self, start, end):
+        return self.client.eth_getLogs(self.address, hex(start), hex(end), self.topics)
+
+    def adapt(self, size, count):
+        if count > self.target:
+            self.window = max(self.min_window, size // 2)
+        elif count < self.target // 4:
+            self.window = min(self.max_window, max(self.window, size * 2))
+
+    def resume_from(self, from_block):
+        if self.checkpoint and os.path.exists(self.checkpoint):
+            with open(self.checkpoint) as f:
+                return max(from_block, json.load(f)["block"] + 1)
+        return from_block
+
+    def save(self, block):
+        if self.checkpoint:
+            with open(self.checkpoint + ".tmp", "w") as f:
+                json.dump({"block": block}, f)
+            os.replace(self.checkpoint + ".tmp", self.checkpoint)
+
+    def scan(self, from_block, to_block):
+        next_block = self.resume_from(from_block)
+        pending = collections.deque()
+        throttled = 0
+
+        with concurrent.futures.ThreadPoolExecutor(self.workers) as executor:
+            def submit(start, end):
+                return (start, end, executor.submit(self.fetch, start, end))
+
+            while pending or next_block <= to_block:
+                while len(pending) < self.workers and next_block <= to_block:
+                    end = min(next_block + self.window - 1, to_block)
+                    pending.append(submit(next_block, end))
+                    next_block = end + 1
+
+                start, end, future = pending.popleft()
+                try:
+                    logs = future.result()
+                except Exception as e:
+                    if is_rate_limit_error(e) and throttled < self.retries:
+                        time.sleep(self.backoff * 2 ** throttled)
+                        throttled += 1
+                        pending.appendleft(submit(start, end))
+                        continue
+                    if start == end or not is_log_range_error(e):
+                        raise
+                    middle = (start + end) // 2
+                    self.window = max(self.min_window, middle - start + 1)
+                    pending.appendleft(submit(middle + 1, end))
+                    pending.appendleft(submit(start, middle))
+                    continue
+
+                throttled = 0
+                self.adapt(end - start + 1, len(logs))
+                yield from logs
+                self.save(end)
+
+
+## Trace export
+
+# Columns of the exported frames: (name, NumPy dtype, nullable). Fixed-size
+# columns are stored as raw little-endian values in <name>.bin; variable-size
+# ones ("var") as the concatenated values in <name>.data and their end
+# offsets (<u8) in <name>.offsets. Nullable columns have a <name>.valid
+# byte per row. Fixed-size columns load with numpy.fromfile(path, dtype)
+TRACE_COLUMNS = [
+    ("block", "<u8", False),
+    ("tx", "<u4", False),
+    ("type", "var", False),
+    ("from", "V20", False),
+    ("to", "V20", True),
+    ("value", "V32", False), # Big-endian uint256
+    ("gas", "<u8", False),
+    ("gasUsed", "<u8", True),
+    ("input", "var", False),
+    ("output", "var", True),
+    ("error", "var", True),
+    ("depth", "<u2", False),
+]
+
+STRUCT_FORMATS = {"<u8": "Q", "<u4": "I", "<u2": "H"}
+
+def encode_trace_row(block, tx, frame):
+    def data(value): # Odd-length outputs are kept as strings in the frames
+        return bytes.fromhex(zeropad(remove_0x(value), len(value) - 1)) \
+            if isinstance(value, str) else value
+    return {
+        "block": block,
+        "tx": tx,
+        "type": frame.type.encode(),
+        "from": frame.from_,
+        "to": frame.to,
+        "value": frame.value.to_bytes(32, "big"),
+        "gas": frame.gas,
+        "gasUsed": frame.gas_used,
+        "input": data(frame.input),
+        "output": data(frame.output),
+        "error": frame.error and frame.error.encode(),
+        "depth": frame.depth,
+    }
+
+# Appends rows to the column files in chunks of `chunk_rows`
+class TraceColumnWriter:
+    def __init__(self, directory, chunk_rows=100000):
+        self.directory = directory
+        self.chunk_rows = chunk_rows
+        self.chunk = []
+        self.rows = 0
+        os.makedirs(directory, exist_ok=True)
+        self.offsets = {}
+        for name, dtype, _ in TRACE_COLUMNS:
+            if dtype == "var":
+                self.offsets[name] = os.path.getsize(self.path(name, "data")) \
+                    if os.path.exists(self.path(name, "data")) else 0
+
+    def path(self, name, ext):
+        return os.path.join(self.directory, f"{name}.{ext}")
+
+    def append(self, block, tx, frame):
+        self.chunk.append(encode_trace_row(block, tx, frame))
+        if len(self.chunk) >= self.chunk_rows:
+            self.flush()
+
+    def write(self, name, ext, data):
+        with open(self.path(name, ext), "ab") as f:
+            f.write(data)
+
+    def flush(self):
+        for name, dtype, nullable in TRACE_COLUMNS:
+            values = [row[name] for row in self.chunk]
+            if nullable:
+                self.write(name, "valid", bytes(value is not None for value in values))
+            values = [value or (0 if dtype in STRUCT_FORMATS else b"") for value in values]
+            if dtype == "var":
+                ends = []
+                for value in values:
+                    self.offsets[name] += len(value)
+                    ends.append(self.offsets[name])
+                self.write(name, "data", b"".join(values))
+                self.write(name, "offsets", struct.pack(f"<{len(ends)}Q", *ends))
+            elif dtype.startswith("V"):
+                size = int(dtype[1:])
+                self.write(name, "bin", b"".join(value.rjust(size, b"\0") for value in values))
+            else:
+                self.write(name, "bin", struct.pack(f"<{len(values)}{STRUCT_FORMATS[dtype]}", *values))
+        self.rows += len(self.chunk)
+        self.chunk = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.flush()
+        with open(self.path("schema", "json"), "w") as f:
+            json.dump({"columns": TRACE_COLUMNS}, f)
+
+# Loads the exported columns: NumPy arrays for the fixed-size ones when
+# NumPy is available, lists otherwise. Nulls are None in the lists
+def read_trace_columns(directory):
+    columns = {}
+    for name, dtype, nullable in TRACE_COLUMNS:
+        def read(ext):
+            with open(os.path.join(directory, f"{name}.{ext}"), "rb") as f:
+                return f.read()
+        if dtype == "var":
+            data = read("data")
+            ends = struct.unpack(f"<{len(read('offsets')) // 8}Q", read("offsets"))
+            values = [data[start:end] for start, end in zip((0,) + ends, ends)]
+        elif numpy is not None and not nullable:
+            columns[name] = numpy.frombuffer(read("bin"), dtype)
+            continue
+        elif dtype.startswith("V"):
+            size, data = int(dtype[1:]), read("bin")
+            values = [data[i:i + size] for i in range(0, len(data), size)]
+        else:
+            data = read("bin")
+            values = list(struct.unpack(f"<{len(data) // int(dtype[2:])}{STRUCT_FORMATS[dtype]}", data))
+        if nullable:
+            values = [value if valid else None for value, valid in zip(values, read("valid"))]
+        columns[name] = values
+    return columns
+
+# Traces every tx in [from_block, to_block] (trace_block on OpenEthereum,
+# debug_traceBlockByNumber on Geth) and appends the frames to `directory`
+def export_traces(client, from_block, to_block, directory, chunk_rows=100000):
+    with TraceColumnWriter(directory, chunk_rows) as writer:
+        for block in range(from_block, to_block + 1):
+            for tx, frame in client.iter_trace_block(hex(block)):
+                writer.append(block, tx, frame)
+    return writer.rows
+
+
+## Trace index
+
+def address_key(address):
+    return intern_address(address) if isinstance(address, str) else address
+
+def selector_key(selector):
+    return parse_data(selector) if isinstance(selector, str) else selector
+
+def frame_selector(frame):
+    if isinstance(frame.input, bytes) and len(frame.input) >= 4:
+        return frame.input[:4]
+    return None
+
+# In-memory index over the normalized frames (TraceFrame) of many txs.
+# Frames get consecutive ids, with posting lists of ids by from and to
+# address, type, selector (first 4 bytes of the input) and failed frames, so
+# a query only walks the ids of its most selective criterion. Parent/child
+# links are rebuilt from the trace addresses, which both clients produce
+# (Geth's from the nesting of the calls)
+class TraceIndex:
+    def __init__(self):
+        self.frames = []
+        self.txs = []
+        self.parents = []
+        self.children = {}
+        self.by_from = collections.defaultdict(list)
+        self.by_to = collections.defaultdict(list)
+        self.by_type = collections.defaultdict(list)
+        self.by_selector = collections.defaultdict(list)
+        self.errored = []
+        self.logs = {}
+
+    def __len__(self):
+        return len(self.frames)
+
+    # Adds the frames of a tx (as returned by trace_transaction, in pre-order)
+    # and optionally the logs of its receipt
+    def add(self, tx, frames, logs=()):
+        ids = {}
+        for frame in frames:
+            id_ = len(self.frames)
+            path = tuple(frame.trace_address)
+            parent = ids.get(path[:-1]) if path else None
+            ids[path] = id_
+            self.frames.append(frame)
+            self.txs.append(tx)
+            self.parents.append(parent)
+            if parent is not None:
+                self.children.setdefault(parent, []).append(id_)
+            self.by_from[frame.from_].append(id_)
+            self.by_to[frame.to].append(id_)
+            self.by_type[frame.type].append(id_)
+            selector = frame_selector(frame)
+            if selector is not None:
+                self.by_selector[selector].append(id_)
+            if frame.error is not None:
+                self.errored.append(id_)
+        for log in logs:
+            log = Log(log) if isinstance(log, dict) else log
+            self.logs.setdefault((tx, log.address), []).append(log)
+
+    def parent(self, id_):
+        return self.parents[id_]
+
+    def get_children(self, id_):
+        return self.children.get(id_, [])
+
+    # Ids of the frames matching all the given criteria. error=True matches
+    # failed frames, error=False successful ones
+    def find(self, from_=None, to=None, type_=None, selector=None, error=None):
+        from_, to, selector = address_key(from_), address_key(to), selector_key(selector)
+        postings = []
+        if from_ is not None:
+            postings.append(self.by_from.get(from_, []))
+        if to is not None:
+            postings.append(self.by_to.get(to, []))
+        if type_ is not None:
+            postings.append(self.by_type.get(type_, []))
+        if selector is not None:
+            postings.append(self.by_selector.get(selector, []))
+        if error:
+            postings.append(self.errored)
+        ids = min(postings, key=len) if postings else range(len(self.frames))
+
+        result = []
+        for id_ in ids:
+            frame = self.frames[id_]
+            if ((from_ is None or frame.from_ == from_) and
+                    (to is None or frame.to == to) and
+                    (type_ is None or frame.type == type_) and
+                    (selector is None or frame_selector(frame) == selector) and
+                    (error is None or (frame.error is not None) == error)):
+                result.append(id_)
+        return result
+
+    def delegatecalls_into(self, address):
+        return self.find(to=address, type_="delegatecall")
+
+    # (parent, child) ids of failed frames whose parent succeeded, as in
+    # test_partial_revert
+    def partial_reverts(self):
+        return [(self.parents[id_], id_) for id_ in self.errored
+                if self.parents[id_] is not None and self.frames[self.parents[id_]].error is None]
+
+    # (id, logs) of the successful delegatecalls whose tx emitted logs under
+    # the address of the caller, the contract whose storage the callee's code
+    # ran on, as in test_impersonate. Needs the logs passed to add()
+    def impersonations(self, to=None):
+        result = []
+        for id_ in self.find(to=to, type_="delegatecall", error=False):
+            logs = self.logs.get((self.txs[id_], self.frames[id_].from_))
+            if logs:
+                result.append((id_, logs))
+        return result
+
+
+## Gas profiler
+
+OPCODES = {
+    0x00: "STOP", 0x01: "ADD", 0x02: "MUL", 0x03: "SUB", 0x04: "DIV", 0x05: "SDIV", 0x06: "MOD",
+    0x07: "SMOD", 0x08: "ADDMOD", 0x09: "MULMOD", 0x0a: "EXP", 0x0b: "SIGNEXTEND",
+    0x10: "LT", 0x11: "GT", 0x12: "SLT", 0x13: "SGT", 0x14: "EQ", 0x15: "ISZERO", 0x16: "AND",
+    0x17: "OR", 0x18: "XOR", 0x19: "NOT", 0x1a: "BYTE", 0x1b: "SHL", 0x1c: "SHR", 0x1d: "SAR",
+    0x20: "KECCAK256",
+    0x30: "ADDRESS", 0x31: "BALANCE", 0x32: "ORIGIN", 0x33: "CALLER", 0x34: "CALLVALUE",
+    0x35: "CALLDATALOAD", 0x36: "CALLDATASIZE", 0x37: "CALLDATACOPY", 0x38: "CODESIZE",
+    0x39: "CODECOPY", 0x3a: "GASPRICE", 0x3b: "EXTCODESIZE", 0x3c: "EXTCODECOPY",
+    0x3d: "RETURNDATASIZE", 0x3e: "RETURNDATACOPY", 0x3f: "EXTCODEHASH",
+    0x40: "BLOCKHASH", 0x41: "COINBASE", 0x42: "TIMESTAMP", 0x43: "NUMBER", 0x44: "PREVRANDAO",
+    0x45: "GASLIMIT", 0x46: "CHAINID", 0x47: "SELFBALANCE", 0x48: "BASEFEE", 0x49: "BLOBHASH",
+    0x4a: "BLOBBASEFEE",
+    0x50: "POP", 0x51: "MLOAD", 0x52: "MSTORE", 0x53: "MSTORE8", 0x54: "SLOAD", 0x55: "SSTORE",
+    0x56: "JUMP", 0x57: "JUMPI", 0x58: "PC", 0x59: "MSIZE", 0x5a: "GAS", 0x5b: "JUMPDEST",
+    0x5c: "TLOAD", 0x5d: "TSTORE", 0x5e: "MCOPY", 0x5f: "PUSH0",
+    0xf0: "CREATE", 0xf1: "CALL", 0xf2: "CALLCODE", 0xf3: "RETURN", 0xf4: "DELEGATECALL",
+    0xf5: "CREATE2", 0xfa: "STATICCALL", 0xfd: "REVERT", 0xfe: "INVALID", 0xff: "SELFDESTRUCT",
+}
+OPCODES.update({0x60 + i: f"PUSH{i + 1}" for i in range(32)})
+OPCODES.update({0x80 + i: f"DUP{i + 1}" for i in range(16)})
+OPCODES.update({0x90 + i: f"SWAP{i + 1}" for i in range(16)})
+OPCODES.update({0xa0 + i: f"LOG{i}" for i in range(5)})
+
+# Stack items taken by each opcode. For DUPn and SWAPn, as counted by
+# OpenEthereum: the items they copy or swap are taken and pushed again
+STACK_INPUTS = {0x01: 2, 0x02: 2, 0x03: 2, 0x04: 2, 0x05: 2, 0x06: 2, 0x07: 2, 0x08: 3, 0x09: 3,
+                0x0a: 2, 0x0b: 2, 0x15: 1, 0x19: 1, 0x20: 2, 0x31: 1, 0x35: 1, 0x37: 3, 0x39: 3,
+                0x3b: 1, 0x3c: 4, 0x3e: 3, 0x3f: 1, 0x40: 1, 0x49: 1, 0x50: 1, 0x51: 1, 0x52: 2,
+                0x53: 2, 0x54: 1, 0x55: 2, 0x56: 1, 0x57: 2, 0x5c: 1, 0x5d: 2, 0x5e: 3, 0xf0: 3,
+                0xf1: 7, 0xf2: 7, 0xf3: 2, 0xf4: 6, 0xf5: 4, 0xfa: 6, 0xfd: 2, 0xff: 1}
+STACK_INPUTS.update({op: 2 for op in range(0x10, 0x1e) if op not in (0x15, 0x19)})
+STACK_INPUTS.update({0x80 + i: i + 1 for i in range(16)})
+STACK_INPUTS.update({0x90 + i: i + 2 for i in range(16)})
+STACK_INPUTS.update({0xa0 + i: i + 2 for i in range(5)})
+
+def opcode_name(code, pc):
+    if pc >= len(code):
+        return "STOP"
+    return OPCODES.get(code[pc], "opcode 0x%02x" % code[pc])
+
+# Gas and steps per (contract, pc, opcode), and per stack of call frames and
+# opcode. The gas of an opcode that calls or creates a contract doesn't
+# include the gas used by the callee
+class GasProfile:
+    def __init__(self):
+        self.ops = collections.defaultdict(lambda: [0, 0])
+        self.stacks = collections.defaultdict(lambda: [0, 0])
+
+    def add(self, path, contract, pc, op, gas):
+        entry = self.ops[(contract, pc, op)]
+        entry[0] += 1
+        entry[1] += gas
+        entry = self.stacks[path + (op,)]
+        entry[0] += 1
+        entry[1] += gas
+
+    # (steps, own gas, gas including subcalls) per stack of call frames
+    def frames(self):
+        frames = collections.defaultdict(lambda: [0, 0, 0])
+        for stack, (steps, gas) in self.stacks.items():
+            path = stack[:-1]
+            frames[path][0] += steps
+            frames[path][1] += gas
+            for depth in range(1, len(path) + 1):
+                frames[path[:depth]][2] += gas
+        return frames
+
+    # Lines for flamegraph.pl / speedscope: "frame;frame;OPCODE gas"
+    def folded(self):
+        return [f"{';'.join(stack)} {gas}" for stack, (_, gas) in sorted(self.stacks.items())
+                if gas]
+
+    def report(self, top=20):
+        total = sum(gas for _, gas in self.ops.values())
+        print(f"{total} gas in {sum(steps for steps, _ in self.ops.values())} steps\n")
+        print(f"{'gas':>10} {'own':>10} {'steps':>8}  frame")
+        for path, (steps, own, gas) in sorted(self.frames().items(), key=lambda item: -item[1][2])[:top]:
+            print(f"{gas:>10} {own:>10} {steps:>8}  {' > '.join(path)}")
+        print(f"\n{'gas':>10} {'steps':>8}  {'pc':>6} opcode        contract")
+        for (contract, pc, op), (steps, gas) in sorted(self.ops.items(), key=lambda item: -item[1][1])[:top]:
+            print(f"{gas:>10} {steps:>8}  {pc:>6} {op:<13} {contract}")
+
+CALL_OPCODES = ("CALL", "CALLCODE", "DELEGATECALL", "STATICCALL", "CREATE", "CREATE2")
+
+# Added to the gas handed to the callee of a CALL or CALLCODE with value
+CALL_STIPEND = 2300
+
+def call_stipend(op, value):
+    return CALL_STIPEND if op in ("CALL", "CALLCODE") and int(value, 16) else 0
+
+def stack_address(value):
+    return "0x%040x" % (int(value, 16) & (2**160 - 1))
+
+# Profiles the steps of Geth's struct logger (with the stack, to know the
+# callees) as they are streamed. The gas of a step is the drop in gas until
+# the next step of the same frame; for a step entering a call, its gasCost
+# minus the gas handed to the callee (without the stipend, which the caller
+# doesn't pay for)
+def profile_struct_logs(steps, root):
+    profile = GasProfile()
+    path, contracts = (root,), [root]
+    previous = None
+    for step in itertools.chain(steps, [None]):
+        if previous is not None:
+            depth = previous["depth"]
+            if step is None or step["depth"] < depth:
+                gas = previous["gasCost"]
+            elif step["depth"] > depth:
+                gas = previous["gasCost"] - step["gas"]
+                if previous["op"] in ("CALL", "CALLCODE"):
+                    gas += call_stipend(previous["op"], previous["stack"][-3])
+            else:
+                gas = previous["gas"] - step["gas"]
+            profile.add(path, contracts[-1], previous["pc"], previous["op"], gas)
+            if step is not None and step["depth"] > depth:
+                op = previous["op"]
+                if op.startswith("CREATE"):
+                    contract = "new contract"
+                else:
+                    contract = stack_address(previous["stack"][-2])
+                label = contract if op == "CALL" else f"{contract} ({op.lower()})"
+                path, contracts = path + (label,), contracts + [contract]
+            elif step is not None and step["depth"] < depth:
+                path, contracts = path[:step["depth"] - depth], contracts[:step["depth"] - depth]
+        previous = step
+    return profile
+
+# Profiles the ops of an OpenEthereum vmTrace as the top level ops are
+# streamed (each one is loaded with its subcalls). Opcodes are named from
+# the code. A vmTrace doesn't have the callee addresses, so subcalls are
+# named after the hash of their code. Nor the stack: it is rebuilt from the
+# items pushed by each op, for the value of the calls (see
+# profile_struct_logs for the stipend)
+def profile_vm_trace(ops, code, root):
+    profile = GasProfile()
+    # Per open frame: [ops, code, path, gas before the next op, pending
+    # call op, gas before it, gas used by the frame, EVM stack]
+    stack = [[iter(ops), code, (root,), None, None, None, 0, []]]
+    while stack:
+        frame = stack[-1]
+        ops, code, path, _, _, _, _, evm_stack = frame
+        for op in ops:
+            used = op["ex"]["used"] if op.get("ex") else None
+            if op.get("sub"):
+                sub_code = bytes.fromhex(remove_0x(op["sub"]["code"]))
+                label = "code " + keccak256(sub_code)[:4].hex()
+                frame[4], frame[5] = op, frame[3]
+                stack.append([iter(op["sub"]["ops"]), sub_code, path + (label,), None, None, None, 0, []])
+                break
+            profile.add(path, root if len(path) == 1 else path[-1], op["pc"],
+                        opcode_name(code, op["pc"]), op["cost"])
+            pop_push(evm_stack, code, op)
+            frame[3] = used
+            frame[6] += op["cost"]
+        else:
+            stack.pop()
+            if stack:
+                parent = stack[-1]
+                op, gas_before, sub_used = parent[4], parent[5], frame[6]
+                name = opcode_name(parent[1], op["pc"])
+                used = op["ex"]["used"] if op.get("ex") else None
+                if gas_before is None or used is None:
+                    gas = op["cost"]
+                else:
+                    value = parent[7][-3] if name in ("CALL", "CALLCODE") and len(parent[7]) >= 3 else "0x0"
+                    gas = max(0, gas_before - used - sub_used + call_stipend(name, value))
+                parent_path = parent[2]
+                profile.add(parent_path, root if len(parent_path) == 1 else parent_path[-1],
+                            op["pc"], name, gas)
+                pop_push(parent[7], parent[1], op)
+                parent[3] = used
+                parent[6] += gas + sub_used
+    return profile
+
+def pop_push(evm_stack, code, op):
+    inputs = STACK_INPUTS.get(code[op["pc"]], 0) if op["pc"] < len(code) else 0
+    del evm_stack[len(evm_stack) - inputs:]
+    if op.get("ex"):
+        evm_stack.extend(op["ex"].get("push") or ())
+
+
+## Differential traces
+
+EMPTY_OUTPUTS = (None, "0x", "0x0")
+
+def is_padded_bool(output):
+    data = remove_0x(output or "")
+    return len(data) == 64 and data[:63] == "0" * 63 and data[63] in "01"
+
+# Empty outputs are written in several ways, and Geth drops the (padded
+# bool) output of some calls
+def same_output(a, b):
+    if a in EMPTY_OUTPUTS:
+        return b in EMPTY_OUTPUTS or is_padded_bool(b)
+    return b in EMPTY_OUTPUTS and is_padded_bool(a)
+
+# (kind, field) -> predicate(a, b) telling whether two different values are
+# still equivalent across clients. Those mapped to None are not compared
+TRACE_EQUIVALENCES = {
+    ("frame", "gas"): None, # Geth and OpenEthereum count the gas of calls differently
+    ("frame", "gasUsed"): None,
+    ("frame", "output"): same_output,
+    ("frame", "error"): lambda a, b: a is not None and b is not None, # Messages differ
+    ("frame", "type"): lambda a, b: {a, b} == {"create", "create2"},
+}
+
+RECEIPT_FIELDS = ("from", "to", "contractAddress", "status", "gasUsed")
+LOG_FIELDS = ("address", "topics", "data")
+FRAME_FIELDS = ("type", "from", "to", "value", "gas", "gasUsed", "input", "output", "error")
+ADDRESS_FIELDS = ("from", "to", "contractAddress", "address")
+DATA_FIELDS = ("input", "output", "data")
+
+class Divergence:
+    def __init__(self, left, right, kind, path, field, a, b):
+        self.left = left
+        self.right = right
+        self.kind = kind
+        self.path = path
+        self.field = field
+        self.a = a
+        self.b = b
+
+    def __repr__(self):
+        where = f" {list(self.path)}" if self.path is not None else ""
+        return (f"{self.kind}{where} {self.field}: {self.a!r} != {self.b!r} "
+                f"({self.left} / {self.right})")
+
+class DiffReport:
+    def __init__(self):
+        self.compared = 0
+        self.divergent = 0
+        self.missing = 0
+        self.divergences = []
+
+    # Divergence count and first example per (kind, field)
+    def summary(self):
+        summary = {}
+        for divergence in self.divergences:
+            key = (divergence.kind, divergence.field)
+            if key not in summary:
+                summary[key] = [0, divergence]
+            summary[key][0] += 1
+        return summary
+
+    def print(self):
+        print(f"{self.compared} txs compared, {self.divergent} divergent, "
+              f"{self.missing} missing on both")
+        for (kind, field), (count, example) in sorted(self.summary().items(),
+                                                      key=lambda item: -item[1][0]):
+            print(f" - {kind} {field}: {count}, e.g. {example}")
+
+# Compares the receipts, logs and trace frames of pairs of txs on two
+# clients, fetched concurrently in batches. Frames are aligned by their
+# trace address, so a missing or extra subcall shows as such instead of
+# shifting every frame after it. With aliases=True (txs replayed on two
+# chains, where the same accounts and contracts have different addresses)
+# differing addresses are learned as aliases the first time they are
+# compared, and must be consistent after that, also inside topics, inputs,
+# outputs and data. first_only stops at the first divergence of each pair,
+# max_divergent stops the whole comparison
+class TraceDiff:
+    def __init__(self, left, right, equivalences=TRACE_EQUIVALENCES, aliases=False,
+                 workers=8, batch_size=50, first_only=False, max_divergent=None):
+        self.left = left
+        self.right = right
+        self.equivalences = equivalences
+        # Left address -> right address, and back
+        self.aliases = {} if aliases else None
+        self.reverse = {}
+        self.workers = workers
+        self.batch_size = batch_size
+        self.first_only = first_only
+        self.max_divergent = max_divergent
+        self.lock = threading.Lock()
+
+    def same_address(self, a, b):
+        if a is None or b is None:
+            return False
+        with self.lock:
+            if a not in self.aliases and b not in self.reverse:
+                self.aliases[a] = b
+                self.reverse[b] = a
+            return self.aliases.get(a) == b
+
+    def same_word(self, a, b):
+        if a == b:
+            return True
+        if a.startswith("0" * 24) and b.startswith("0" * 24):
+            return self.same_address(prepend_0x(a[24:]), prepend_0x(b[24:]))
+        return False
+
+    # Compared word by word (after the selector), for the addresses in them,
+    # or else with the aliases already known replaced (e.g. in code)
+    def same_data(self, a, b):
+        a, b = remove_0x(a), remove_0x(b)
+        if len(a) != len(b):
+            return False
+        start = len(a) % 64
+        if start in (0, 8) and a[:start] == b[:start] and all(
+                self.same_word(a[i:i + 64], b[i:i + 64]) for i in range(start, len(a), 64)):
+            return True
+        with self.lock:
+            aliases = list(self.aliases.items())
+        for x, y in aliases:
+            if remove_0x(x) in a:
+                a = a.replace(remove_0x(x), remove_0x(y))
+        return a == b
+
+    def same(self, kind, field, a, b):
+        if a == b:
+            return True
+        if (kind, field) in self.equivalences:
+            rule = self.equivalences[(kind, field)]
+            if rule is None or rule(a, b):
+                return True
+        if self.aliases is None or a is None or b is None:
+            return False
+        if field in ADDRESS_FIELDS:
+            return self.same_address(a, b)
+        if field in DATA_FIELDS:
+            return self.same_data(a, b)
+        if field == "topics":
+            return len(a) == len(b) and all(self.same_word(remove_0x(x), remove_0x(y))
+                                            for x, y in zip(a, b))
+        return False
+
+    # None when neither client knows the tx
+    def compare_pair(self, left, right, receipts, traces):
+        if all(isinstance(receipt, NullResult) for receipt in receipts):
+            return None
+        divergences = []
+
+        def check(kind, path, field, a, b):
+            if not self.same(kind, field, a, b):
+                divergences.append(Divergence(left, right, kind, path, field, a, b))
+            return self.first_only and divergences
+
+        for (kind, a, b) in [("receipt", *receipts), ("trace", *traces)]:
+            if isinstance(a, Exception) or isinstance(b, Exception):
+                divergences.append(Divergence(left, right, kind, None, "fetch",
+                                              None if not isinstance(a, Exception) else str(a),
+                                              None if not isinstance(b, Exception) else str(b)))
+        if divergences:
+            return divergences
+
+        a, b = receipts
+        for field in RECEIPT_FIELDS:
+            if check("receipt", None, field, a.get(field), b.get(field)):
+                return divergences
+        if check("receipt", None, "logs", len(a["logs"]), len(b["logs"])):
+            return divergences
+        for index, (x, y) in enumerate(zip(a["logs"], b["logs"])):
+            for field in LOG_FIELDS:
+                if check("log", (index,), field, x.get(field), y.get(field)):
+                    return divergences
+
+        a = {tuple(frame.trace_address): frame for frame in traces[0]}
+        b = {tuple(frame.trace_address): frame for frame in traces[1]}
+        for path in sorted(a.keys() | b.keys()):
+            if path not in a or path not in b:
+                if check("frame", path, "missing", path in a, path in b):
+                    return divergences
+                continue
+            for field in FRAME_FIELDS:
+                if check("frame", path, field, a[path][field], b[path][field]):
+                    return divergences
+        return divergences
+
+    @staticmethod
+    def fetch(client, txhashes):
+        with client.batch() as batch:
+            calls = [(batch.eth_getTransactionReceipt(txhash), batch.trace_transaction(txhash))
+                     for txhash in txhashes]
+        return [tuple(result_or_exception(call) for call in pair) for pair in calls]
+
+    # The left side is fetched by `fetcher` while this thread fetches the right
+    def compare_batch(self, pairs, fetcher):
+        left = fetcher.submit(self.fetch, self.left, [a for a, _ in pairs])
+        right = self.fetch(self.right, [b for _, b in pairs])
+        left = left.result()
+        return [self.compare_pair(a, b, (x[0], y[0]), (x[1], y[1]))
+                for (a, b), x, y in zip(pairs, left, right)]
+
+    # pairs: (tx hash on the left client, tx hash on the right client)
+    def compare(self, pairs):
+        report = DiffReport()
+        batches = [pairs[i:i + self.batch_size] for i in range(0, len(pairs), self.batch_size)]
+        executor = concurrent.futures.ThreadPoolExecutor(self.workers)
+        fetcher = concurrent.futures.ThreadPoolExecutor(self.workers)
+        try:
+            futures = [executor.submit(self.compare_batch, batch, fetcher) for batch in batches]
+            for future in concurrent.futures.as_completed(futures):
+                for divergences in future.result():
+                    if divergences is None:
+                        report.missing += 1
+                        continue
+                    report.compared += 1
+                    report.divergent += bool(divergences)
+                    report.divergences.extend(divergences)
+                if self.max_divergent is not None and report.divergent >= self.max_divergent:
+                    break
+        finally:
+            executor.shutdown(cancel_futures=True)
+            fetcher.shutdown(cancel_futures=True)
+        return report
+
+    # The same txs, on two nodes of the same chain
+    def compare_hashes(self, txhashes):
+        return self.compare([(txhash, txhash) for txhash in txhashes])
+
+    # Runs scenario(client) (returning the hashes of the txs it sent) on both
+    # clients at the same time, then compares its txs pairwise. The accounts
+    # and contracts of each run have their own addresses, so unless told
+    # otherwise they are compared as aliases
+    def replay(self, scenario, aliases=True):
+        if aliases and self.aliases is None:
+            self.aliases, self.reverse = {}, {}
+        with concurrent.futures.ThreadPoolExecutor(2) as executor:
+            left, right = executor.map(scenario, [self.left, self.right])
+        if len(left) != len(right):
+            raise Exception(f"The scenario sent {len(left)} and {len(right)} txs")
+        return self.compare(list(zip(left, right)))
+
+def result_or_exception(call):
+    try:
+        return call.result()
+    except Exception as e:
+        return e
+
+
+## Async client
+
+class AsyncTransport:
+    """Keep-alive HTTP/1.1 connections over asyncio streams, pooled per endpoint"""
+
+    def __init__(self, pool_size=100, timeout=30):
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.idle = {}
+
+    # The timeout covers the whole exchange: connecting, sending the request
+    # and reading the response
+    async def post(self, host, port, data):
+        data = data.encode()
+        request = (f"POST / HTTP/1.1\r\nHost: {host}:{port}\r\n"
+                   f"Content-Type: application/json\r\n"
+                   f"Content-Length: {len(data)}\r\n\r\n").encode() + data
+        return await asyncio.wait_for(self.exchange(host, port, request), self.timeout)
+
+    async def exchange(self, host, port, request):
+        idle = self.idle.setdefault((host, port), [])
+
+        while True:
+            reused = bool(idle)
+            reader, writer = idle.pop() if reused else await asyncio.open_connection(host, port)
+            try:
+                writer.write(request)
+                await writer.drain()
+                status, headers, body = await self.read_response(reader)
+                break
+            except (ConnectionError, asyncio.IncompleteReadError):
+                writer.close()
+                if not reused: # Idle connections may have been closed by the node
+                    raise
+            except BaseException:
+                writer.close()
+                raise
+
+        if headers.get("connection") != "close" and len(idle) < self.pool_size:
+            idle.append((reader, writer))
+        else:
+            writer.close()
+
+        if status != 200:
+            raise Exception(body.decode())
+        return body
+
+    @staticmethod
+    async def read_response(reader):
+        status = int((await reader.readuntil(b"\r\n")).split()[1])
+        headers = {}
+        while True:
+            line = (await reader.readuntil(b"\r\n")).decode().strip()
+            if not line:
+                break
+            name, value = line.split(":", 1)
+            headers[name.strip().lower()] = value.strip().lower()
+
+        if "content-length" in headers:
+            return status, headers, await reader.readexactly(int(headers["content-length"]))
+
+        if headers.get("transfer-encoding") == "chunked":
+            chunks = []
+            while True:
+                size = int((await reader.readuntil(b"\r\n")).split(b";")[0], 16)
+                chunks.append(await reader.readexactly(size + 2))
+                if size == 0:
+                    return status, headers, b"".join(chunk[:-2] for chunk in chunks)
+
+        headers["connection"] = "close"
+        return status, headers, await reader.read()
+
+    def close(self):
+        for idle in self.idle.values():
+            for _, writer in idle:
+                writer.close()
+        self.idle.clear()
+
+# Same surface as Client, with coroutines. At most `concurrency` calls are in
+# flight at any time; the rest wait on the semaphore
+class AsyncClient:
+    desc = Client.desc
+
+    def __init__(self, host, port, verbose, transport=None, concurrency=100, metrics=None):
+        self.host = host
+        self.port = port
+        self.verbose = verbose
+        self.transport = transport or AsyncTransport(concurrency)
+        self.metrics = metrics or METRICS
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.ids = itertools.count(1)
+
+    async def _call(self, method, params):
+        req = RPCRequest(self.host, self.port, method, params, id_=next(self.ids))
+        if self.verbose:
+            print(">>", req.as_curl())
+        data = json.dumps(req.get_data())
+        async with self.semaphore:
+            with self.metrics.measure(self.desc, method) as sample:
+                content = await self.transport.post(self.host, self.port, data)
+                start = time.time()
+                body = json.loads(content)
+                sample.sent, sample.received = len(data), len(content)
+                sample.parse = time.time() - start
+                res = RPCRequest.parse(body)
+        if self.verbose:
+            print("<<", dumps(res))
+        return res
+
+    async def eth_accounts(self):
+        return await self._call("eth_accounts", [])
+
+    async def personal_sendTransaction(self, from_, to_, value_, nonce, gas, gasPrice, data):
+        req = {
+            "from": from_,
+            "to": to_,
+            "value": hex(value_),
+            "nonce": hex(nonce),
+            "gas": hex(gas),
+            "gasPrice": hex(gasPrice),
+            "data": data
+        }
+        return await self._call("personal_sendTransaction", [req, ""])
+
+    async def eth_call(self, to_, data, at_):
+        return await self._call("eth_call", [{"to": to_, "data": data}, at_])
+
+    async def eth_blockNumber(self):
+        return await self._call("eth_blockNumber", [])
+
+    async def eth_getTransactionCount(self, address, block="pending"):
+        return await self._call("eth_getTransactionCount", [address, block])
+
+    async def eth_getTransactionByHash(self, txhash):
+        return await self._call("eth_getTransactionByHash", [txhash])
+
+    async def eth_getTransactionReceipt(self, txhash):
+        return Receipt(await self._call("eth_getTransactionReceipt", [txhash]))
+
+    async def eth_getLogs(self, address, fromBlock, toBlock, topics):
+        req = {
+            "address": address,
+            "fromBlock": fromBlock,
+            "toBlock": toBlock,
+            "topics": topics
+        }
+        return await self._call("eth_getLogs", [req])
+
+    async def trace_transaction(self, txhash):
+        return self.parse_trace(await self._call(*self.trace_request(txhash)))
+
+    async def trace_transactions(self, txhashes):
+        return await asyncio.gather(*map(self.trace_transaction, txhashes))
+
+class AsyncOpenEthereumClient(AsyncClient):
+    desc = OpenEthereumClient.desc
+    normalize = OpenEthereumClient.normalize
+    trace_request = OpenEthereumClient.trace_request
+    parse_trace = OpenEthereumClient.parse_trace
+
+class AsyncGethClient(AsyncClient):
+    desc = GethClient.desc
+    flatten = GethClient.flatten
+    trace_request = GethClient.trace_request
+    parse_trace = GethClient.parse_trace
+
+
+## Confirmations
+
+# Waits for many pending txs at once. While there are pending txs a single
+# poller thread watches for new blocks with eth_newBlockFilter (or
+# eth_blockNumber when filters are not available), backing off while the
+# chain is idle. Only the txs included in the new blocks get their receipts
+# fetched, so the load doesn't grow with the number of pending txs.
+# Websocket subscriptions are not used: there is no websocket client here.
+# Each watch() of a tx must be followed by its receipt or a forget()
+class ConfirmationWatcher:
+    def __init__(self, client, min_interval=0.05, max_interval=1.0):
+        self.client = client
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.pending = {}
+        self.waiters = {}
+        self.unchecked = set()
+        self.failed_blocks = []
+        self.lock = threading.Lock()
+        self.poller = None
+        self.use_filter = True
+        self.filter_id = None
+        self.last_block = None
+
+    def watch(self, txhash):
+        with self.lock:
+            if txhash not in self.pending:
+                self.pending[txhash] = concurrent.futures.Future()
+                # It may have been mined in a block we have already seen
+                self.unchecked.add(txhash)
+            self.waiters[txhash] = self.waiters.get(txhash, 0) + 1
+            if self.poller is None:
+                self.poller = threading.Thread(target=self.run, daemon=True)
+                self.poller.start()
+            return self.pending[txhash]
+
+    def wait(self, txhashes, timeout=60):
+        futures = [self.watch(txhash) for txhash in txhashes]
+        start = time.time()
+        deadline = start + timeout
+        receipts = []
+        try:
+            for txhash, future in zip(txhashes, futures):
+                try:
+                    receipts.append(future.result(max(0, deadline - time.time())))
+                except concurrent.futures.TimeoutError:
+                    raise Exception(f"Timeout waiting for tx {txhash}")
+        finally:
+            self.client.metrics.add_wait(self.client.desc, time.time() - start)
+            # Stop watching the rest too, or the poller would never stop
+            for txhash, future in zip(txhashes, futures):
+                if not future.done():
+                    self.forget(txhash)
+        return receipts
+
+    # The tx is only dropped once no one else is waiting for it
+    def forget(self, txhash):
+        with self.lock:
+            if txhash not in self.pending:
+                return
+            self.waiters[txhash] -= 1
+            if not self.waiters[txhash]:
+                del self.waiters[txhash]
+                del self.pending[txhash]
+
+    def run(self):
+        interval = self.min_interval
+        while True:
+            with self.lock:
+                if not self.pending:
+                    self.poller = None
+                    return
+                unchecked, self.unchecked = self.unchecked, set()
+            try:
+                included = self.new_transactions()
+                # When the tx was seen in a block, before its receipt was fetched
+                now = time.time()
+                with self.lock:
+                    for txhash in included & self.pending.keys():
+                        self.pending[txhash].included = now
+                self.resolve(unchecked | included)
+                interval = self.min_interval if included else min(interval * 1.5, self.max_interval)
+            except Exception:
+                with self.lock:
+                    self.unchecked |= unchecked
+                interval = self.max_interval
+            # Replayed or in-process chains don't need polling intervals, but
+            # the loop still yields so it doesn't spin a core
+            time.sleep(interval if self.client.transport.realtime else 0.001)
+
+    # Hashes of the txs included in blocks since the last poll
+    def new_transactions(self):
+        if self.use_filter and self.filter_id is None:
+            try:
+                self.filter_id = self.client._call("eth_newBlockFilter", [])
+            except RPCError:
+                self.use_filter = False
+
+        if self.use_filter:
+            try:
+                calls = [("eth_getBlockByHash", [blockhash, False]) for blockhash in
+                         self.client._call("eth_getFilterChanges", [self.filter_id])]
+            except RPCError: # Filters expire when not polled for a while
+                self.filter_id = None
+                self.failed_blocks = []
+                with self.lock:
+                    return set(self.pending)
+        else:
+            number = int(self.client.eth_blockNumber(), 16)
+            first = number if self.last_block is None else self.last_block + 1
+            self.last_block = number
+            calls = [("eth_getBlockByNumber", [hex(n), False]) for n in range(first, number + 1)]
+
+        # Blocks that couldn't be fetched are not seen again: they are
+        # retried on the next polls
+        calls = self.failed_blocks + calls
+        blocks = self.client.call_many(calls, return_exceptions=True)
+        self.failed_blocks = [call for call, block in zip(calls, blocks)
+                              if not isinstance(block, dict)]
+        return {txhash for block in blocks if isinstance(block, dict)
+                for txhash in block["transactions"]}
+
+    def resolve(self, txhashes):
+        with self.lock:
+            txhashes = [txhash for txhash in txhashes if txhash in self.pending]
+        receipts = self.client.call_many(
+            [("eth_getTransactionReceipt", [txhash]) for txhash in txhashes],
+            return_exceptions=True)
+        with self.lock:
+            for txhash, receipt in zip(txhashes, receipts):
+                # Null until the tx is mined (unchecked txs may not be yet)
+                if isinstance(receipt, dict) and txhash in self.pending:
+                    self.waiters.pop(txhash)
+                    self.pending.pop(txhash).set_result(Receipt(receipt))
+
+
+## Utils
+
+def dumps(obj):
+    return json.dumps(obj, indent="  ")
+
+def remove_0x(string_):
+    if string_.startswith("0x"):
+        return string_[2:]
+    return string_
+
+def prepend_0x(string_):
+    if not string_.startswith("0x"):
+        return "0x" + string_
+    return string_
+
+def zeropad(str_, size):
+    return "0" * (size - len(str_)) + str_
+
+def percentile(values, p):
+    values = sorted(values)
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+# Keccak-256 as used by Ethereum (original padding, not NIST SHA3-256)
+KECCAK_ROTATIONS = [
+    [0, 36, 3, 41, 18], [1, 44, 10, 45, 2], [62, 6, 43, 15, 61],
+    [28, 55, 25, 21, 56], [27, 20, 39, 8, 14],
+]
+
+def keccak_round_constants():
+    constants, r = [], 1
+    for _ in range(24):
+        rc = 0
+        for j in range(7):
+            r = ((r << 1) ^ ((r >> 7) * 0x71)) & 0xff
+            if r & 2:
+                rc ^= 1 << ((1 << j) - 1)
+        constants.append(rc)
+    return constants
+
+KECCAK_ROUND_CONSTANTS = keccak_round_constants()
+
+def keccak_f(lanes):
+    mask = (1 << 64) - 1
+    rol = lambda v, n: ((v << n) | (v >> (64 - n))) & mask if n else v
+    for rc in KECCAK_ROUND_CONSTANTS:
+        c = [lanes[x] ^ lanes[x + 5] ^ lanes[x + 10] ^ lanes[x + 15] ^ lanes[x + 20]
+             for x in range(5)]
+        d = [c[(x - 1) % 5] ^ rol(c[(x + 1) % 5], 1) for x in range(5)]
+        b = [0] * 25
+        for x in range(5):
+            for y in range(5):
+                b[y + 5 * ((2 * x + 3 * y) % 5)] = rol(lanes[x + 5 * y] ^ d[x],
+                                                       KECCAK_ROTATIONS[x][y])
+        lanes = [b[i] ^ (~b[(i + 1) % 5 + i // 5 * 5] & b[(i + 2) % 5 + i // 5 * 5])
+                 for i in range(25)]
+        lanes[0] ^= rc
+    return lanes
+
+def keccak256(data):
+    rate = 136
+    padded = bytearray(data) + b"\x01" + b"\x00" * (-(len(data) + 1) % rate)
+    padded[-1] |= 0x80
+    lanes = [0] * 25
+    for offset in range(0, len(padded), rate):
+        for i in range(rate // 8):
+            lanes[i] ^= int.from_bytes(padded[offset + 8 * i:offset + 8 * i + 8], "little")
+        lanes = keccak_f(lanes)
+    return b"".join(lane.to_bytes(8, "little") for lane in lanes[:4])
+
+def rlp_encode(item):
+    if isinstance(item, list):
+        payload = b"".join(map(rlp_encode, item))
+        prefix = 0xc0
+    else:
+        if len(item) == 1 and item[0] < 0x80:
+            return item
+        payload = item
+        prefix = 0x80
+    if len(payload) <= 55:
+        return bytes([prefix + len(payload)]) + payload
+    length = len(payload).to_bytes((len(payload).bit_length() + 7) // 8, "big")
+    return bytes([prefix + 55 + len(length)]) + length + payload
+
+# Address of a contract created by `sender` with the given nonce
+def contract_address(sender, nonce):
+    encoded = rlp_encode([bytes.fromhex(remove_0x(sender)),
+                          nonce.to_bytes((nonce.bit_length() + 7) // 8, "big")])
+    return prepend_0x(keccak256(encoded)[12:].hex())
+
+# solc outputs, keyed by the hash of the sources, the solc version and the
+# flags. Kept in memory and on disk, so they survive between runs. Imported
+# files are not part of the key (none of the sources in src/ import others)
+class CompileCache:
+    def __init__(self, directory=os.path.join(".cache", "solc")):
+        self.directory = directory
+        self.entries = {}
+        self.version = None
+        self.lock = threading.Lock()
+
+    def solc_version(self):
+        if self.version is None:
+            self.version = self.solc(["--version"])
+        return self.version
+
+    @staticmethod
+    def solc(args):
+        proc = subprocess.run(["solc"] + args, capture_output=True, encoding='utf8')
+
+        if proc.returncode:
+            sys.stderr.write(proc.stderr)
+            proc.check_returncode()
+
+        return proc.stdout
+
+    def key(self, filenames, flags):
+        digest = hashlib.sha256(self.solc_version().encode())
+        digest.update(json.dumps(flags).encode())
+        for filename in filenames:
+            with open(filename, "rb") as f:
+                digest.update(filename.encode() + b"\0" + f.read() + b"\0")
+        return digest.hexdigest()
+
+    def run(self, filenames, flags):
+        with self.lock:
+            key = self.key(filenames, flags)
+            path = os.path.join(self.directory, key + ".out")
+            if key not in self.entries and os.path.exists(path):
+                with open(path) as f:
+                    self.entries[key] = f.read()
+            if key not in self.entries:
+                self.entries[key] = self.solc(filenames + flags)
+                os.makedirs(self.directory, exist_ok=True)
+                with open(path + ".tmp", "w") as f:
+                    f.write(self.entries[key])
+                os.replace(path + ".tmp", path)
+            return self.entries[key]
+
+SOLC_CACHE = CompileCache()
+
+Contract = collections.namedtuple("Contract", "name bytecode abi selectors")
+
+# Compiles every source in `directory` with a single solc call. Returns the
+# contracts by "<filename>:<name>", with their selectors by signature
+def compile_all(directory="src"):
+    filenames = sorted(glob.glob(os.path.join(directory, "*.sol")))
+    output = json.loads(SOLC_CACHE.run(filenames, ["--combined-json", "bin,abi,hashes"]))
+    contracts = {}
+    for name, contract in sorted(output["contracts"].items()):
+        abi = contract["abi"]
+        contracts[name] = Contract(
+            name, prepend_0x(contract["bin"]),
+            json.loads(abi) if isinstance(abi, str) else abi, # String before solc 0.8
+            {signature: prepend_0x(selector) for signature, selector in contract["hashes"].items()})
+    return contracts
+
+# Bytecode of the contract named after `filename` (e.g. TestToken in
+# src/TestToken.sol), or of its only contract
+def compile(filename):
+    contracts = {name.rsplit(":", 1)[1]: contract for name, contract in
+                 compile_all(os.path.dirname(filename)).items()
+                 if os.path.samefile(name.rsplit(":", 1)[0], filename)}
+    stem = os.path.splitext(os.path.basename(filename))[0]
+    if stem in contracts:
+        return contracts[stem].bytecode
+    if len(contracts) == 1:
+        return next(iter(contracts.values())).bytecode
+    raise ValueError(f"No contract named {stem} in {filename}, and {len(contracts)} others")
+
+# Nonces are handed out locally, so several txs from the same sender can be
+# submitted back to back without waiting for each one to be mined. The next
+# nonce is fetched again from the node after a failed send, or on resync()
+# (e.g. after a tx was replaced or dropped)
+class NonceManager:
+    def __init__(self):
+        self.nonces = {}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def key(client, sender):
+        return (client.host, client.port, sender.lower())
+
+    def next(self, client, sender):
+        with self.lock:
+            key = self.key(client, sender)
+            if key not in self.nonces:
+                self.nonces[key] = int(client.eth_getTransactionCount(sender), 16)
+            nonce = self.nonces[key]
+            self.nonces[key] += 1
+            return nonce
+
+    def resync(self, client, sender):
+        with self.lock:
+            self.nonces.pop(self.key(client, sender), None)
+
+    # Forgets all the senders of the client's node
+    def reset(self, client):
+        with self.lock:
+            for key in [key for key in self.nonces if key[:2] == (client.host, client.port)]:
+                del self.nonces[key]
+
+NONCES = NonceManager()
+
+def submit_tx(client, sender, to_, data, gas=4000000, value=0, nonces=NONCES):
+    nonce = nonces.next(client, sender)
+    try:
+        txhash = client.personal_sendTransaction(sender, to_, value, nonce, gas, 10**9, data)
+    except Exception:
+        nonces.resync(client, sender)
+        raise
+    return txhash, nonce
+
+# Returns the tx hash and the address the contract will have once mined
+def submit_deploy(client, sender, code, nonces=NONCES):
+    txhash, nonce = submit_tx(client, sender, None, code, 1000000, nonces=nonces)
+    return txhash, contract_address(sender, nonce)
+
+def wait_receipts(client, txhashes, error="TX failed"):
+    receipts = client.confirmations.wait(txhashes)
+    for receipt in receipts:
+        if receipt["status"] != "0x1":
+            raise Exception(error)
+    return receipts
+
+def deploy_contract(client, sender, code):
+    txhash, _ = submit_deploy(client, sender, code)
+    receipt, = wait_receipts(client, [txhash], "Deployment failed")
+    return receipt["contractAddress"]
+
+def contract_send_tx(client, sender, contractAddress, data):
+    txhash, _ = submit_tx(client, sender, contractAddress, data)
+    receipt, = wait_receipts(client, [txhash], "Sending TX to contract failed")
+    return receipt
+
+def contract_call(client, contractAddress, data):
+    return client.eth_call(contractAddress, data, "latest")
+
+def erc20_balanceOf(client, token, address):
+    data = prepend_0x(encode_call("balanceOf(address)", address).hex())
+    return contract_call(client, token, data)
+
+
+## ABI
+
+# Encoding and decoding of the ABI types used here: uint<N>, int<N>,
+# address, bool, bytes<N>, bytes, string and dynamic arrays (T[]) of them.
+# Decoding works on bytes or memoryviews without going through hex strings
+
+@functools.lru_cache(maxsize=None)
+def function_selector(signature):
+    return keccak256(signature.encode())[:4]
+
+@functools.lru_cache(maxsize=None)
+def event_topic(signature):
+    return keccak256(signature.encode())
+
+@functools.lru_cache(maxsize=None)
+def signature_types(signature):
+    types = signature[signature.index("(") + 1:signature.rindex(")")]
+    return tuple(types.split(",")) if types else ()
+
+def is_dynamic_type(type_):
+    return type_ in ("bytes", "string") or type_.endswith("[]")
+
+def encode_word(type_, value):
+    if type_ == "address":
+        value = bytes.fromhex(remove_0x(value)) if isinstance(value, str) else value
+        return value.rjust(32, b"\0")
+    if type_ == "bool":
+        return int(bool(value)).to_bytes(32, "big")
+    if type_.startswith("uint"):
+        return value.to_bytes(32, "big")
+    if type_.startswith("int"):
+        return value.to_bytes(32, "big", signed=True)
+    if type_.startswith("bytes"):
+        return value.ljust(32, b"\0")
+    raise ValueError(f"Unsupported type {type_}")
+
+def encode_tail(type_, value, pad):
+    if type_ in ("bytes", "string"):
+        data = value.encode() if type_ == "string" else value
+        padding = b"\0" * (-len(data) % 32) if pad else b""
+        return len(data).to_bytes(32, "big") + data + padding
+    return len(value).to_bytes(32, "big") + abi_encode([type_[:-2]] * len(value), value, pad)
+
+# With pad=False the last dynamic value is not padded to 32 bytes, as some
+# senders do (see the submitTransaction() calldata in the Runner tests)
+def abi_encode(types, values, pad=True):
+    heads, tails = [], []
+    offset = 32 * len(types)
+    dynamic = [i for i, type_ in enumerate(types) if is_dynamic_type(type_)]
+    for i, (type_, value) in enumerate(zip(types, values)):
+        if is_dynamic_type(type_):
+            tail = encode_tail(type_, value, pad or i != dynamic[-1])
+            heads.append(offset.to_bytes(32, "big"))
+            tails.append(tail)
+            offset += len(tail)
+        else:
+            heads.append(encode_word(type_, value))
+    return b"".join(heads + tails)
+
+def encode_call(signature, *args, pad=True):
+    return function_selector(signature) + abi_encode(signature_types(signature), args, pad)
+
+def decode_word(type_, word):
+    if type_ == "address":
+        return prepend_0x(bytes(word[12:32]).hex())
+    if type_ == "bool":
+        return word[31] != 0
+    if type_.startswith("uint"):
+        return int.from_bytes(word[:32], "big")
+    if type_.startswith("int"):
+        return int.from_bytes(word[:32], "big", signed=True)
+    if type_.startswith("bytes"):
+        return bytes(word[:int(type_[5:])])
+    raise ValueError(f"Unsupported type {type_}")
+
+# Values past the end of the data are an error. Missing padding after the
+# last dynamic value (and extra trailing bytes) are accepted, unless strict
+def abi_decode(types, data, strict=False):
+    data = memoryview(data)
+    values = []
+    for i, type_ in enumerate(types):
+        if len(data) < 32 * (i + 1):
+            raise ValueError(f"Data too short for {type_} at {32 * i}")
+        word = data[32 * i:32 * (i + 1)]
+        if not is_dynamic_type(type_):
+            values.append(decode_word(type_, word))
+            continue
+        offset = int.from_bytes(word, "big")
+        length = int.from_bytes(data[offset:offset + 32], "big")
+        if offset + 32 > len(data):
+            raise ValueError(f"Offset of {type_} out of range")
+        if type_ in ("bytes", "string"):
+            end = offset + 32 + length
+            if end > len(data) or (strict and end + (-length % 32) > len(data)):
+                raise ValueError(f"Data too short for {type_} of length {length}")
+            value = bytes(data[offset + 32:end])
+            values.append(value.decode() if type_ == "string" else value)
+        else:
+            # Checked before building the types list: each element has a 32 bytes head
+            if offset + 32 + 32 * length > len(data):
+                raise ValueError(f"Data too short for {type_} of length {length}")
+            values.append(list(abi_decode([type_[:-2]] * length, data[offset + 32:], strict)))
+    return tuple(values)
+
+def decode_call(signature, data, strict=False):
+    data = memoryview(data)
+    if data[:4] != function_selector(signature):
+        raise ValueError(f"Selector doesn't match {signature}")
+    return abi_decode(signature_types(signature), data[4:], strict)
 
-    def get_data(self):
-        return {
-            "jsonrpc" : "2.0",
-            "method" : self.method,
-            "params" : self.params,
-            "id": 1
-        }
+# Decodes many values of the same types at once, returning one list per
+# type. Static types are decoded column by column out of a single buffer,
+# with one conversion per column instead of one per value. NumPy, when
+# available, is used to slice the columns out of a (rows, types, 32) array
+# and to convert integers of up to 64 bits (when no value in the column has
+# high bytes set, which the pure Python path keeps)
+def abi_decode_columns(types, datas):
+    if any(map(is_dynamic_type, types)):
+        return [list(column) for column in zip(*(abi_decode(types, data) for data in datas))] \
+            or [[] for _ in types]
+    size = 32 * len(types)
+    for data in datas:
+        if len(data) < size:
+            raise ValueError(f"Data too short for {types}")
+    return decode_static_columns(types, b"".join(bytes(data[:size]) for data in datas))
 
-    def execute(self):
-        resp = requests.post(
-            "http://%s:%s" % (self.host, self.port),
-            headers={"Content-Type": "application/json"},
-            data=json.dumps(self.get_data()),
-        )
+def decode_static_columns(types, buffer):
+    size = 32 * len(types)
+    rows = range(len(buffer) // size)
+    words = None
+    if numpy is not None:
+        words = numpy.frombuffer(buffer, numpy.uint8).reshape(len(rows), len(types), 32)
 
-        if resp.status_code != 200:
-            raise Exception(resp.text)
+    columns = []
+    for i, type_ in enumerate(types):
+        if words is not None and type_.startswith("uint") and int(type_[4:] or 256) <= 64 \
+                and not words[:, i, :24].any():
+            columns.append(numpy.ascontiguousarray(words[:, i, 24:]).view(">u8")[:, 0].tolist())
+            continue
 
-        body = json.loads(resp.text)
+        if len(types) == 1:
+            column = buffer
+        elif words is not None:
+            column = numpy.ascontiguousarray(words[:, i, :]).tobytes()
+        else:
+            column = b"".join(buffer[row * size + 32 * i:row * size + 32 * (i + 1)] for row in rows)
 
-        if body.get("error"):
-            raise Exception(body['error'])
+        if type_ == "address":
+            hex_ = column.hex()
+            columns.append(["0x" + hex_[64 * row + 24:64 * (row + 1)] for row in rows])
+        elif type_ == "bool":
+            columns.append([column[32 * row + 31] != 0 for row in rows])
+        elif type_.startswith("uint") or type_.startswith("int"):
+            signed = type_.startswith("int")
+            columns.append([int.from_bytes(column[32 * row:32 * (row + 1)], "big", signed=signed)
+                            for row in rows])
+        else:
+            columns.append([decode_word(type_, column[32 * row:32 * (row + 1)]) for row in rows])
+    return columns
 
-        if body["result"] is None:
-            raise Exception("null result")
+# Decodes the indexed (topics) and non-indexed (data) fields of many logs of
+# the same event, returning one list per field, indexed fields first. The
+# hex of all the logs is converted in a single call
+def decode_log_columns(logs, indexed_types, data_types):
+    count = len(indexed_types) + 1
+    topics = bytes.fromhex("".join(topic[2:] for log in logs for topic in log["topics"][1:count]))
+    if len(topics) != 32 * len(indexed_types) * len(logs):
+        raise ValueError(f"Logs don't have {len(indexed_types)} indexed fields")
+    columns = decode_static_columns(indexed_types, topics) if indexed_types else []
 
-        return body["result"]
+    datas = [log["data"][2:] for log in logs]
+    if not any(map(is_dynamic_type, data_types)) and \
+            sum(map(len, datas)) == 64 * len(data_types) * len(logs):
+        return columns + decode_static_columns(data_types, bytes.fromhex("".join(datas)))
+    return columns + abi_decode_columns(data_types, [bytes.fromhex(data) for data in datas])
 
-    def as_curl(self):
-        return (f"curl -X POST " + 
-                f"--data '{json.dumps(self.get_data())}' " +
-                f"--header 'Content-Type: application/json' " +
-                f"http://{self.host}:{self.port}")
+## Stub server
 
-# See https://eth.wiki/json-rpc/API
-class Client:
-    def __init__(self, host, port, verbose):
-        self.host = host
-        self.port = port
-        self.verbose = verbose
+STUB_RESULTS = {
+    "eth_accounts": ["0x00a329c0648769a73afac7f9381e08fb43dbea72"],
+    "eth_blockNumber": "0x1",
+    "eth_getTransactionCount": "0x0",
+    "eth_getBalance": "0x0",
+    "eth_call": "0x" + "0" * 64,
+    "eth_getTransactionReceipt": {"status": "0x1", "blockNumber": "0x1", "logs": []},
+    "trace_transaction": [],
+    "debug_traceTransaction": {"type": "CALL", "calls": []},
+}
 
-    def __call(self, method, params):
-        req = RPCRequest(self.host, self.port, method, params)
-        if self.verbose:
-            print(">>", req.as_curl())
-        res = req.execute()
-        if self.verbose:
-            print("<<", dumps(res))
-        return res
+def stub_handler(method, params):
+    if method not in STUB_RESULTS:
+        raise Exception(f"Method {method} not supported")
+    return STUB_RESULTS[method]
 
-    def _call(self, method, params):
-        return self.__call(method, params)
+# Response body for a decoded request (or batch) answered by `handler`
+def dispatch_rpc(handler, req):
+    if isinstance(req, list):
+        return [dispatch_rpc(handler, r) for r in req]
+    try:
+        result = handler(req["method"], req.get("params", []))
+        return {"jsonrpc": "2.0", "id": req["id"], "result": result}
+    except RPCError as e:
+        return {"jsonrpc": "2.0", "id": req["id"], "error": e.error}
+    except Exception as e:
+        return {"jsonrpc": "2.0", "id": req["id"],
+                "error": {"code": -32000, "message": str(e)}}
 
-    def eth_accounts(self):
-        return self.__call("eth_accounts", [])
+class StubRPCServer:
+    """Local JSON-RPC server answering from a handler(method, params)"""
 
-    def personal_sendTransaction(self, from_, to_, value_, nonce, gas, gasPrice, data):
-        req = {
-            "from": from_,
-            "to": to_,
-            "value": hex(value_),
-            "nonce": hex(nonce),
-            "gas": hex(gas),
-            "gasPrice": hex(gasPrice),
-            "data": data
-        }
-        return self.__call("personal_sendTransaction", [req, ""])
+    def __init__(self, handler=stub_handler, host="127.0.0.1", port=0):
+        outer = self
 
-    def eth_call(self, to_, data, at_):
-        req = {
-            "to": to_,
-            "data": data
-        }
-        return self.__call("eth_call", [req, at_])
+        class RequestHandler(http.server.BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            disable_nagle_algorithm = True
+
+            def do_POST(self):
+                length = int(self.headers["Content-Length"])
+                body = json.dumps(outer.dispatch(json.loads(self.rfile.read(length))))
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body.encode())
+
+            def log_message(self, *args):
+                pass
+
+        class Server(http.server.ThreadingHTTPServer):
+            daemon_threads = True
+            request_queue_size = 1024
+
+        self.handler = handler
+        self.server = Server((host, port), RequestHandler)
+        self.host, self.port = self.server.server_address[:2]
+
+    def dispatch(self, req):
+        return dispatch_rpc(self.handler, req)
+
+    def __enter__(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *args):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+## In-process EVM
+
+# OpenEthereum names of the py-evm errors, as they appear in traces
+EVM_ERRORS = {
+    "Revert": "Reverted",
+    "OutOfGas": "Out of gas",
+    "InsufficientFunds": "Insufficient balance for transfer",
+    "InvalidInstruction": "Bad instruction",
+    "InvalidJumpDestination": "Bad jump destination",
+    "StackDepthLimit": "Out of stack",
+    "WriteProtection": "Mutable Call In Static Context",
+}
+
+# Importing py-evm raises the recursion limit of the whole interpreter (so
+# runaway recursion crashes instead of raising RecursionError). It is put
+# back once the modules are loaded
+def import_evm():
+    global eth, eth_keys
+    if eth is not None:
+        return
+    limit = sys.getrecursionlimit()
+    try:
+        import eth.chains.base
+        import eth.db.atomic
+        import eth.db.backends.memory
+        import eth.exceptions
+        import eth.vm.forks
+        import eth.vm.spoof
+        import eth_keys
+    except ImportError:
+        eth = None
+        raise Exception("The in-process EVM needs py-evm (pip install py-evm)")
+    finally:
+        sys.setrecursionlimit(limit)
+
+def evm_address(address):
+    return prepend_0x(address.hex()) if address else None
+
+def evm_data(data):
+    return prepend_0x(bytes(data).hex())
+
+def evm_bytes(data):
+    return bytes.fromhex(remove_0x(data or "0x"))
+
+# Answers JSON-RPC calls from an in-process py-evm chain. Every tx is mined
+# in its own block as soon as it is sent (txs with a nonce ahead of their
+# sender's wait for the missing ones, as in a node's tx pool). Traces are
+# built from the tree of computations of each tx, in the format of
+# OpenEthereum's trace module
+class EVMTransport(Transport):
+    realtime = False
+
+    CHAIN_ID = 1337
+
+    METHODS = (
+        "eth_accounts", "eth_chainId", "eth_blockNumber", "eth_getBalance",
+        "eth_getTransactionCount", "eth_getCode", "eth_call", "eth_getBlockByNumber",
+        "eth_getBlockByHash", "eth_getTransactionByHash", "eth_getTransactionReceipt",
+        "eth_getLogs", "personal_newAccount", "personal_sendTransaction",
+        "trace_transaction", "trace_block", "evm_snapshot", "evm_revert",
+    )
+
+    def __init__(self, accounts=10, balance=10**24):
+        import_evm()
+        self.chain_class = eth.chains.base.MiningChain.configure(
+            __name__="EVMChain", vm_configuration=((0, eth.vm.forks.CancunVM),),
+            chain_id=self.CHAIN_ID)
+        self.keys = {}
+        for _ in range(accounts):
+            self.personal_newAccount("")
+        self.memory = eth.db.backends.memory.MemoryDB()
+        self.chain = self.chain_class.from_genesis(eth.db.atomic.AtomicDB(self.memory), {
+            "difficulty": 0,
+            "gas_limit": 30000000,
+            "timestamp": int(time.time()),
+        }, {
+            bytes.fromhex(remove_0x(address)): {"balance": balance, "nonce": 0, "code": b"", "storage": {}}
+            for address in self.keys
+        })
+        self.traces = {}
+        self.queued = {}
+        self.snapshots = []
+        self.lock = threading.Lock()
+
+    def handle(self, method, params):
+        if method not in self.METHODS:
+            raise Exception(f"Method {method} not supported")
+        with self.lock:
+            return getattr(self, method)(*params)
+
+    def post(self, url, data):
+        return json.dumps(dispatch_rpc(self.handle, json.loads(data))).encode()
+
+    def post_stream(self, url, data, **kwargs):
+        yield self.post(url, data)
+
+    def state(self):
+        return self.chain.get_vm().state
+
+    def header(self, block):
+        if block in ("latest", "pending"):
+            return self.chain.get_canonical_head()
+        if block == "earliest":
+            block = "0x0"
+        return self.chain.get_canonical_block_header_by_number(int(block, 16))
+
+    def eth_accounts(self):
+        return list(self.keys)
+
+    def eth_chainId(self):
+        return hex(self.CHAIN_ID)
 
     def eth_blockNumber(self):
-        return self.__call("eth_blockNumber", [])
+        return hex(self.chain.get_canonical_head().block_number)
+
+    def eth_getBalance(self, address, block="latest"):
+        state = self.chain.get_vm(self.header(block)).state
+        return hex(state.get_balance(evm_bytes(address)))
 
     def eth_getTransactionCount(self, address, block="pending"):
-        return self.__call("eth_getTransactionCount", [address, block])
+        state = self.chain.get_vm(self.header(block)).state
+        return hex(state.get_nonce(evm_bytes(address)))
 
-    def eth_getTransactionByHash(self, txhash):
-        return self.__call("eth_getTransactionByHash", [txhash])
+    def eth_getCode(self, address, block="latest"):
+        return evm_data(self.chain.get_vm(self.header(block)).state.get_code(evm_bytes(address)))
 
-    def eth_getTransactionReceipt(self, txhash):
-        return self.__call("eth_getTransactionReceipt", [txhash])
+    def eth_call(self, tx, block="latest"):
+        sender = evm_bytes(tx.get("from") or next(iter(self.keys)))
+        vm = self.chain.get_vm()
+        unsigned = vm.create_unsigned_transaction(
+            nonce=vm.state.get_nonce(sender), gas_price=0, gas=int(tx.get("gas", "0x1c9c380"), 16),
+            to=evm_bytes(tx.get("to")), value=int(tx.get("value", "0x0"), 16),
+            data=evm_bytes(tx.get("data", tx.get("input"))))
+        try:
+            return evm_data(self.chain.get_transaction_result(
+                eth.vm.spoof.SpoofTransaction(unsigned, from_=sender), self.header(block)))
+        except eth.exceptions.Revert as e:
+            raise RPCError({"code": 3, "message": "execution reverted", "data": evm_data(e.args[0])})
+        except eth.exceptions.VMError as e:
+            raise RPCError({"code": -32000, "message": EVM_ERRORS.get(type(e).__name__, str(e))})
 
-    def eth_getLogs(self, address, fromBlock, toBlock, topics):
-        req = {
-            "address": address,
-            "fromBlock": fromBlock,
-            "toBlock": toBlock,
-            "topics": topics
+    def block(self, block, full):
+        txs = [self.transaction(block, index) if full else evm_data(tx.hash)
+               for index, tx in enumerate(block.transactions)]
+        return {
+            "number": hex(block.number),
+            "hash": evm_data(block.hash),
+            "parentHash": evm_data(block.header.parent_hash),
+            "timestamp": hex(block.header.timestamp),
+            "gasLimit": hex(block.header.gas_limit),
+            "gasUsed": hex(block.header.gas_used),
+            "baseFeePerGas": hex(block.header.base_fee_per_gas),
+            "miner": evm_address(block.header.coinbase),
+            "transactions": txs,
         }
-        return self.__call("eth_getLogs", [req])
 
-    def trace_transaction(self, txhash):
-        raise NotImplemented()
+    def eth_getBlockByNumber(self, number, full=False):
+        try:
+            header = self.header(number)
+        except eth.exceptions.HeaderNotFound:
+            return None
+        return self.block(self.chain.get_block_by_header(header), full)
 
-class OpenEthereumClient(Client):
-    desc = "OpenEth"
+    def eth_getBlockByHash(self, blockhash, full=False):
+        try:
+            return self.block(self.chain.get_block_by_hash(evm_bytes(blockhash)), full)
+        except eth.exceptions.HeaderNotFound:
+            return None
 
-    @classmethod
-    def normalize(cls, trace):
+    # (block, index) of a mined tx, or (None, None)
+    def locate(self, txhash):
+        try:
+            number, index = self.chain.chaindb.get_transaction_index(evm_bytes(txhash))
+        except eth.exceptions.TransactionNotFound:
+            return None, None
+        return self.chain.get_canonical_block_by_number(number), index
+
+    def transaction(self, block, index):
+        tx = block.transactions[index]
         return {
-          "type": trace["action"]["callType"] if trace["type"] == "call" else trace["type"],
-          "from": trace["action"]["from"],
-          "to": trace["action"]["to"],
-          "value": trace["action"]["value"],
-          "gas": trace["action"]["gas"],
-          "gasUsed": trace.get("result", {}).get("gasUsed"),
-          "input": trace["action"]["input"],
-          "output": trace.get("result", {}).get("output"),
-          "error": trace.get("error")
+            "hash": evm_data(tx.hash),
+            "nonce": hex(tx.nonce),
+            "blockHash": evm_data(block.hash),
+            "blockNumber": hex(block.number),
+            "transactionIndex": hex(index),
+            "from": evm_address(tx.sender),
+            "to": evm_address(tx.to),
+            "value": hex(tx.value),
+            "gas": hex(tx.gas),
+            "gasPrice": hex(tx.gas_price),
+            "input": evm_data(tx.data),
         }
 
-    # https://openethereum.github.io/JSONRPC-trace-module
-    def trace_transaction(self, txhash):
-        traces = self._call("trace_transaction", [txhash])
-        return list(map(self.normalize, traces))
+    def eth_getTransactionByHash(self, txhash):
+        block, index = self.locate(txhash)
+        return self.transaction(block, index) if block else None
 
+    def logs(self, block, index, receipt):
+        return [{
+            "address": evm_address(log.address),
+            "topics": ["0x%064x" % topic for topic in log.topics],
+            "data": evm_data(log.data),
+            "blockNumber": hex(block.number),
+            "blockHash": evm_data(block.hash),
+            "transactionHash": evm_data(block.transactions[index].hash),
+            "transactionIndex": hex(index),
+            "logIndex": hex(i),
+            "removed": False,
+        } for i, log in enumerate(receipt.logs)]
 
-class GethClient(Client):
-    desc = "Geth"
+    def eth_getTransactionReceipt(self, txhash):
+        block, index = self.locate(txhash)
+        if block is None:
+            return None
+        tx = block.transactions[index]
+        receipt = block.get_receipts(self.chain.chaindb)[index]
+        return {
+            "transactionHash": evm_data(tx.hash),
+            "transactionIndex": hex(index),
+            "blockHash": evm_data(block.hash),
+            "blockNumber": hex(block.number),
+            "from": evm_address(tx.sender),
+            "to": evm_address(tx.to),
+            "contractAddress": None if tx.to else contract_address(evm_address(tx.sender), tx.nonce),
+            "gasUsed": hex(receipt.gas_used),
+            "cumulativeGasUsed": hex(receipt.gas_used),
+            "status": "0x1" if receipt.state_root == b"\x01" else "0x0",
+            "logs": self.logs(block, index, receipt),
+        }
 
-    @classmethod
-    def flatten(cls, trace):
-        parent = {
-          "type": trace["type"].lower(),
-          "from": trace["from"],
-          "to": trace["to"],
-          "value": trace.get("value", "0x0"), # Not present on delegate calls
-          "gas": trace["gas"],
-          "gasUsed": trace["gasUsed"],
-          "input": trace["input"],
-          "output": trace.get("output"),
-          "error": trace.get("error")
+    def eth_getLogs(self, filter_):
+        head = self.chain.get_canonical_head().block_number
+        first = self.header(filter_.get("fromBlock", "latest")).block_number
+        last = self.header(filter_.get("toBlock", "latest")).block_number
+        addresses = filter_.get("address") or []
+        addresses = {a.lower() for a in ([addresses] if isinstance(addresses, str) else addresses)}
+        topics = filter_.get("topics") or []
+        logs = []
+        for number in range(first, min(last, head) + 1):
+            block = self.chain.get_canonical_block_by_number(number)
+            for index, receipt in enumerate(block.get_receipts(self.chain.chaindb)):
+                for log in self.logs(block, index, receipt):
+                    if addresses and log["address"] not in addresses:
+                        continue
+                    if all(topic is None or (log["topics"][i:i + 1] and log["topics"][i] in
+                                             ([topic] if isinstance(topic, str) else topic))
+                           for i, topic in enumerate(topics)):
+                        logs.append(log)
+        return logs
+
+    def personal_newAccount(self, password):
+        key = eth_keys.keys.PrivateKey(keccak256(b"account %d" % len(self.keys)))
+        address = evm_address(key.public_key.to_canonical_address())
+        self.keys[address] = key
+        return address
+
+    def personal_sendTransaction(self, tx, password):
+        sender = tx["from"].lower()
+        if sender not in self.keys:
+            raise Exception(f"Unknown account {sender}")
+        vm = self.chain.get_vm()
+        nonce = int(tx["nonce"], 16) if "nonce" in tx else vm.state.get_nonce(evm_bytes(sender))
+        signed = vm.create_unsigned_transaction(
+            nonce=nonce, gas_price=int(tx.get("gasPrice", "0x3b9aca00"), 16),
+            gas=int(tx.get("gas", "0x15f90"), 16), to=evm_bytes(tx.get("to")),
+            value=int(tx.get("value", "0x0"), 16), data=evm_bytes(tx.get("data"))
+        ).as_signed_transaction(self.keys[sender], chain_id=self.CHAIN_ID)
+        if nonce < vm.state.get_nonce(evm_bytes(sender)):
+            raise Exception("nonce too low")
+        self.queued[(sender, nonce)] = signed
+        while (sender, vm.state.get_nonce(evm_bytes(sender))) in self.queued:
+            self.mine(self.queued.pop((sender, vm.state.get_nonce(evm_bytes(sender)))))
+            vm = self.chain.get_vm()
+        return evm_data(signed.hash)
+
+    def mine(self, signed):
+        _, _, computation = self.chain.apply_transaction(signed)
+        block = self.chain.mine_block()
+        txhash = evm_data(signed.hash)
+        self.traces[txhash] = [dict(trace, transactionHash=txhash, blockNumber=block.number,
+                                    blockHash=evm_data(block.hash), transactionPosition=0)
+                               for trace in self.trace(computation)]
+
+    # Frames in pre-order, with an explicit stack as calls can be 1024 deep,
+    # and the trace address pushed and popped along the walk
+    def trace(self, computation):
+        traces = [self.trace_frame(computation, [])]
+        address = []
+        stack = [enumerate(computation.children)]
+        while stack:
+            for index, child in stack[-1]:
+                address.append(index)
+                traces.append(self.trace_frame(child, list(address)))
+                stack.append(enumerate(child.children))
+                break
+            else:
+                stack.pop()
+                if stack:
+                    address.pop()
+        return traces
+
+    @staticmethod
+    def trace_frame(computation, address):
+        msg = computation.msg
+        if msg.is_create:
+            type_ = "create"
+            action = {"from": evm_address(msg.sender), "value": hex(msg.value),
+                      "gas": hex(msg.gas), "init": evm_data(msg.code)}
+            result = {"gasUsed": hex(computation.get_gas_used()),
+                      "code": evm_data(computation.output),
+                      "address": evm_address(msg.storage_address)}
+        else:
+            type_ = "call"
+            # Told apart by the message params set by the calling opcode: only
+            # CALL and CALLCODE transfer value (a STATICCALL in a static
+            # context is still one, a CALL there is still a CALL)
+            if msg.code_address != msg.storage_address:
+                call_type = "delegatecall" if not msg.should_transfer_value else "callcode"
+                from_ = msg.storage_address
+            else:
+                call_type = "call" if msg.should_transfer_value else "staticcall"
+                from_ = msg.sender
+            action = {"callType": call_type, "from": evm_address(from_),
+                      "to": evm_address(msg.code_address), "value": hex(msg.value),
+                      "gas": hex(msg.gas), "input": evm_data(msg.data)}
+            result = {"gasUsed": hex(computation.get_gas_used()),
+                      "output": evm_data(computation.output)}
+        trace = {
+            "type": type_,
+            "action": action,
+            "result": result,
+            "subtraces": len(computation.children),
+            "traceAddress": address,
         }
-        return [parent] + sum(list(map(cls.flatten, trace.get('calls',[]))), [])
+        if computation.is_error:
+            name = type(computation.error).__name__
+            trace["result"] = None
+            trace["error"] = EVM_ERRORS.get(name, name)
+        return trace
 
-    # https://geth.ethereum.org/docs/dapp/tracing
-    # https://geth.ethereum.org/docs/rpc/ns-debug#debug_tracetransaction
     def trace_transaction(self, txhash):
-        trace = self._call("debug_traceTransaction", [txhash, {"tracer": "callTracer"}])
-        return self.flatten(trace)
+        return self.traces.get(txhash)
 
+    def trace_block(self, number):
+        block = self.chain.get_block_by_header(self.header(number))
+        return [dict(trace, transactionPosition=position)
+                for position, tx in enumerate(block.transactions)
+                for trace in self.traces.get(evm_data(tx.hash), [])]
 
-## Utils
+    # The whole chain database is copied: meant for the small chains of tests
+    def evm_snapshot(self):
+        self.snapshots.append((dict(self.memory.kv_store), dict(self.traces), dict(self.queued)))
+        return hex(len(self.snapshots) - 1)
 
-def dumps(obj):
-    return json.dumps(obj, indent="  ")
+    # Drops the snapshot and any later one, as in ganache
+    def evm_revert(self, snapshot):
+        index = int(snapshot, 16)
+        if index >= len(self.snapshots):
+            return False
+        kv_store, self.traces, self.queued = self.snapshots[index]
+        del self.snapshots[index:]
+        self.memory = eth.db.backends.memory.MemoryDB(kv_store)
+        self.chain = self.chain_class(eth.db.atomic.AtomicDB(self.memory))
+        return True
 
-def remove_0x(string_):
-    if string_.startswith("0x"):
-        return string_[2:]
-    return string_
+# Client for an in-process chain: the test scenarios run without nodes.
+# Traces are normalized as OpenEthereum traces
+class EVMClient(OpenEthereumClient):
+    desc = "EVM"
 
-def prepend_0x(string_):
-    if not string_.startswith("0x"):
-        return "0x" + string_
-    return string_
+    def __init__(self, verbose=False, accounts=10, cache=None, metrics=None):
+        transport = EVMTransport(accounts)
+        super().__init__("evm", id(transport), verbose, transport, cache, metrics)
 
-def zeropad(str_, size):
-    return "0" * (size - len(str_)) + str_
+    def snapshot(self):
+        return self._call("evm_snapshot", [])
 
-def compile(filename):
-    cmd = ["solc", filename, "--bin"]
+    # The nonces handed out for the chain are dropped too
+    def revert(self, snapshot, nonces=NONCES):
+        reverted = self._call("evm_revert", [snapshot])
+        nonces.reset(self)
+        return reverted
+
+
+## Benchmarks
+
+def bench_transport(calls=2000):
+    with StubRPCServer() as server:
+        for name, transport in [("per-call", SimpleTransport()),
+                                ("pooled", PooledTransport())]:
+            client = Client(server.host, server.port, False, transport)
+            latencies = []
+            start = time.perf_counter()
+            for _ in range(calls):
+                t = time.perf_counter()
+                client.eth_blockNumber()
+                latencies.append(time.perf_counter() - t)
+            elapsed = time.perf_counter() - start
+            print(f" - {name}: {calls / elapsed:.0f} calls/s, "
+                  f"p50 {percentile(latencies, 50) * 1000:.2f}ms, "
+                  f"p99 {percentile(latencies, 99) * 1000:.2f}ms")
+
+# Stub nodes answering in about 1ms, but in 50ms 3% of the time. The last
+# one is stuck 10 blocks behind, so the pool ejects it
+def bench_pool(calls=1000):
+    def node(seed, head):
+        rng = random.Random(seed)
+        def handle(method, params):
+            time.sleep(0.05 if rng.random() < 0.03 else 0.001)
+            if method == "eth_blockNumber":
+                return hex(head)
+            return stub_handler(method, params)
+        return handle
+
+    with StubRPCServer(node(1, 100)) as a, StubRPCServer(node(2, 100)) as b, \
+         StubRPCServer(node(3, 90)) as c:
+        clients = [Client(server.host, server.port, False) for server in (a, b, c)]
+        for name, hedge in [("single", None), ("pool", False), ("pool+hedge", True)]:
+            pool = None
+            client = clients[0]
+            if hedge is not None:
+                pool = EndpointPool(clients, probe_interval=0.1, hedge=hedge)
+                client = pool.client()
+            latencies = []
+            start = time.perf_counter()
+            for _ in range(calls):
+                t = time.perf_counter()
+                client.eth_call("0x" + "00" * 20, "0x", "0x1")
+                latencies.append(time.perf_counter() - t)
+            elapsed = time.perf_counter() - start
+            print(f" - {name}: {calls / elapsed:.0f} calls/s, "
+                  f"p50 {percentile(latencies, 50) * 1000:.2f}ms, "
+                  f"p99 {percentile(latencies, 99) * 1000:.2f}ms")
+            if pool:
+                pool.report()
+                pool.close()
+
+def synthetic_call_trace(width, depth):
+    def call(index):
+        return {"type": "CALL", "from": "0x%040x" % index, "to": "0x%040x" % (index + 1),
+                "value": "0x0", "gas": "0x5208", "gasUsed": "0x5208", "input": "0x", "output": "0x"}
+    root = call(0)
+    root["calls"] = [call(i) for i in range(width)]
+    node = root
+    for i in range(depth):
+        node["calls"] = node.get("calls", []) + [call(i)]
+        node = node["calls"][-1]
+    return root
+
+# The previous, recursive implementation, as a baseline
+def flatten_recursive(trace):
+    return [GethClient.frame(trace, [])] + sum(list(map(flatten_recursive, trace.get('calls',[]))), [])
+
+def bench_flatten():
+    for name, trace in [("wide (10000 x 1)", synthetic_call_trace(10000, 0)),
+                        ("deep (1 x 5000)", synthetic_call_trace(0, 5000))]:
+        for impl, flatten in [("recursive", flatten_recursive),
+                              ("iterative", GethClient.flatten)]:
+            start = time.time()
+            try:
+                frames = len(flatten(trace))
+                print(f" - {name}, {impl}: {frames} frames in {elapsed_since(start)}")
+            except RecursionError:
+                print(f" - {name}, {impl}: RecursionError after {elapsed_since(start)}")
 
-    proc = subprocess.run(cmd, capture_output=True, encoding='utf8')
+def bench_abi(count=100000):
+    logs = [{"topics": [prepend_0x(event_topic("Transfer(address,address,uint256)").hex()),
+                        prepend_0x(zeropad("%x" % i, 64)), prepend_0x(zeropad("%x" % (i + 1), 64))],
+             "data": prepend_0x(zeropad("%x" % (i * 7), 64))} for i in range(count)]
 
-    if proc.returncode:
-        sys.stderr.write(proc.stderr)
-        proc.check_returncode()
+    start = time.time()
+    [(prepend_0x(remove_0x(log["topics"][1])[24:]), prepend_0x(remove_0x(log["topics"][2])[24:]),
+      int(remove_0x(log["data"]), 16)) for log in logs]
+    print(f" - hex slicing: {count} Transfer logs in {elapsed_since(start)}")
 
-    return prepend_0x([x for x in proc.stdout.split('\n') if x][-1])
+    start = time.time()
+    [abi_decode(["address", "address", "uint256"],
+                bytes.fromhex("".join(remove_0x(topic) for topic in log["topics"][1:]) +
+                              remove_0x(log["data"]))) for log in logs]
+    print(f" - abi_decode per log: {count} Transfer logs in {elapsed_since(start)}")
 
-def wait_condition(action, condition, max_retries, on_retry=lambda: time.sleep(1)):
-    attempts = 0
-    success = False
+    start = time.time()
+    decode_log_columns(logs, ["address", "address"], ["uint256"])
+    print(f" - decode_log_columns: {count} Transfer logs in {elapsed_since(start)}")
 
-    while True:
+def bench_index(txs=20000, width=50):
+    target = "0x" + "ee" * 20
+    index = TraceIndex()
+    start = time.time()
+    for i in range(txs):
+        trace = synthetic_call_trace(width, 0)
+        trace["to"] = "0x%040x" % (10**6 + i % 1000)
+        if i % 100 == 0:
+            trace["calls"][i % width].update(type="DELEGATECALL", to=target)
+        if i % 7 == 0:
+            trace["calls"][0]["error"] = "execution reverted"
+        index.add(i, GethClient.flatten(trace))
+    print(f" - indexed {len(index)} frames in {elapsed_since(start)}")
+
+    key = intern_address(target)
+    for name, scan, query in [
+            ("delegatecalls into address",
+             lambda: [id_ for id_, f in enumerate(index.frames) if f.type == "delegatecall" and f.to == key],
+             lambda: index.delegatecalls_into(target)),
+            ("partial reverts",
+             lambda: [(index.parents[id_], id_) for id_, f in enumerate(index.frames)
+                      if f.error is not None and index.parents[id_] is not None
+                      and index.frames[index.parents[id_]].error is None],
+             index.partial_reverts)]:
+        start = time.time()
+        expected = scan()
+        scanned = elapsed_since(start)
+        start = time.time()
+        assert query() == expected
+        print(f" - {name}: {len(expected)} found, scan {scanned}, index {elapsed_since(start)}")
+
+BENCHMARKS = {
+    "transport": bench_transport,
+    "flatten": bench_flatten,
+    "abi": bench_abi,
+    "index": bench_index,
+    "pool": bench_pool,
+}
+
+
+## Load generator
+
+LOAD_TEMPLATES = "load"
+
+# Values for the template placeholders when running against stub servers
+STUB_CONTEXT = {
+    "ACCOUNT": STUB_RESULTS["eth_accounts"][0],
+    "TXHASH": "0x" + "11" * 32,
+    "TOKEN": "0x" + "22" * 20,
+}
+
+# Request templates are curl commands (as in requests/, which are left
+# ready to run by hand), the call is taken from --data. ${ACCOUNT}, ${TXHASH} and ${TOKEN} are replaced by an account,
+# a mined tx and a deployed TestToken of the node under load
+def load_template(path):
+    with open(path) as f:
+        match = re.search(r"--data\s+'(.*?)'", f.read(), re.DOTALL)
+    if match is None:
+        raise Exception(f"No --data in {path}")
+    return match.group(1)
+
+def render_template(template, context):
+    req = json.loads(string.Template(template).safe_substitute(context))
+    return req["method"], req["params"]
+
+# Each client traces with its own API
+def load_call(client, method, params):
+    if method == "trace_transaction":
+        return client.trace_request(params[0])
+    return method, params
+
+def load_context(client, templates):
+    account = client.eth_accounts()[0]
+    context = {"ACCOUNT": account}
+    used = "".join(templates.values())
+    if "${TOKEN}" in used:
+        context["TOKEN"] = deploy_contract(client, account, compile("src/TestToken.sol"))
+    if "${TXHASH}" in used:
+        if "TOKEN" in context:
+            txhash, _ = submit_tx(client, account, context["TOKEN"], prepend_0x(
+                encode_call("transfer(address,uint256)", account, 1).hex()))
+        else:
+            txhash, _ = submit_tx(client, account, account, "0x", 21000)
+        wait_receipts(client, [txhash])
+        context["TXHASH"] = txhash
+    return context
+
+def percentiles_ms(latencies):
+    return {f"p{p}_ms": percentile(latencies, p) * 1000 if latencies else None
+            for p in (50, 95, 99)}
+
+def load_summary(latencies, errors, elapsed):
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "error_rate": errors / len(latencies) if latencies else 0,
+        "throughput": len(latencies) / elapsed,
+        **percentiles_ms(latencies),
+    }
+
+# Sends the (name, method, params) calls round robin for `duration` seconds,
+# either `concurrency` at a time or, with `rate`, started at a fixed rate
+# (with up to `concurrency` in flight). At a fixed rate latencies count from
+# the time each call was due, so a node that falls behind shows it
+def run_load(client, calls, duration, rate=None, concurrency=10):
+    latencies = collections.defaultdict(list)
+    errors = collections.Counter()
+    lock = threading.Lock()
+
+    def send(name, method, params, due):
         try:
-            ret = action()
-            if condition(ret):
-                success = True
-                return ret
-        finally:
-            if not success:
-                attempts += 1
-                if attempts == max_retries + 1:
-                    raise Exception("Max number of retries reached")
-                on_retry()
-
-def wait_confirmation(client, txhash):
-    return wait_condition(
-        lambda: client.eth_getTransactionByHash(txhash), 
-        lambda tx: tx["blockHash"] is not None,
-        10
-    )
+            client._call(method, params)
+            error = 0
+        except Exception:
+            error = 1
+        with lock:
+            latencies[name].append(time.time() - due)
+            errors[name] += error
 
-def wait_receipt(client, txhash):
-    return wait_condition(
-        lambda: client.eth_getTransactionReceipt(txhash), 
-        lambda _: True,
-        10
-    )
+    start = time.time()
+    deadline = start + duration
+    if rate:
+        with concurrent.futures.ThreadPoolExecutor(concurrency) as executor:
+            for i, call in enumerate(itertools.cycle(calls)):
+                due = start + i / rate
+                if due >= deadline:
+                    break
+                time.sleep(max(0, due - time.time()))
+                executor.submit(send, *call, due)
+    else:
+        counter = itertools.count()
 
-def deploy_contract(client, sender, code):
-    nonce = int(client.eth_getTransactionCount(sender), 16)
-    txhash = client.personal_sendTransaction(sender, None, 0, nonce, 1000000, 10**9, code)
-    wait_confirmation(client, txhash)
-    receipt = wait_receipt(client, txhash)
-    if receipt["status"] != "0x1":
-        raise Exception("Deployment failed")
-    return receipt["contractAddress"]
+        def worker():
+            while time.time() < deadline:
+                send(*calls[next(counter) % len(calls)], time.time())
 
-def contract_send_tx(client, sender, contractAddress, data):
-    nonce = int(client.eth_getTransactionCount(sender), 16)
-    txhash = client.personal_sendTransaction(sender, contractAddress, 0, nonce, 4000000, 10**9, data)
-    wait_confirmation(client, txhash)
-    receipt = wait_receipt(client, txhash)
-    if receipt["status"] != "0x1":
-        raise Exception("Sending TX to contract failed")
-    return receipt
+        threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    elapsed = time.time() - start
 
-def contract_call(client, contractAddress, data):
-    return client.eth_call(contractAddress, data, "latest")
+    summary = {name: load_summary(latencies[name], errors[name], elapsed)
+               for name, _, _ in calls}
+    summary["all"] = load_summary(sum(latencies.values(), []), sum(errors.values()), elapsed)
+    return summary
 
-def erc20_balanceOf(client, token, address):
-    data = "0x70a08231" + zeropad(remove_0x(address), 64)
-    return contract_call(client, token, data)
+
+## Stress
+
+# A tx sent by a stress run, with the times it was submitted, accepted by
+# the node, seen in a block and had its receipt fetched
+class StressTx:
+    def __init__(self, sender, submitted):
+        self.sender = sender
+        self.submitted = submitted
+        self.sent = None
+        self.included = None
+        self.confirmed = None
+        self.txhash = None
+        self.nonce = None
+        self.receipt = None
+        self.error = None
+
+    def confirm(self, future):
+        self.confirmed = time.time()
+        self.included = getattr(future, "included", self.confirmed)
+        self.receipt = future.result()
+
+# Gives each sender `amount` tokens of a new TestToken, returns its address
+def fund_token(client, funder, senders, amount):
+    token = deploy_contract(client, funder, compile("src/TestToken.sol"))
+    txhashes = [submit_tx(client, funder, token, prepend_0x(
+        encode_call("transfer(address,uint256)", sender, amount).hex()))[0] for sender in senders]
+    wait_receipts(client, txhashes, "Token funding failed")
+    return token
+
+# Sends transfers round robin from `senders` new accounts at `rate` txs per
+# second for `duration` seconds, without waiting for each one to be mined:
+# the confirmation watcher resolves them as they are included. With `token`
+# the transfers are TestToken transfers instead of plain value transfers.
+# Txs not confirmed `timeout` seconds after the last submit are reported as
+# mined late (they have a receipt by then), pending (still known to the
+# node), replaced (their nonce was used by another tx) or dropped
+def run_stress(client, rate, senders, duration, token=False, timeout=60):
+    accounts = create_funded_accounts(client, senders)
+    if token:
+        to_ = fund_token(client, client.eth_accounts()[0], accounts, 10000 // senders)
+        data = prepend_0x(encode_call("transfer(address,uint256)", to_, 1).hex())
+        gas = 100000
+    else:
+        to_, data, gas = client.eth_accounts()[0], "0x", 21000
+
+    txs = []
+
+    def send(tx):
+        try:
+            tx.txhash, tx.nonce = submit_tx(client, tx.sender, to_, data, gas)
+        except Exception as e:
+            tx.error = str(e)
+            return
+        tx.sent = time.time()
+        client.confirmations.watch(tx.txhash).add_done_callback(tx.confirm)
+
+    start = time.time()
+    with concurrent.futures.ThreadPoolExecutor(len(accounts)) as executor:
+        for i in itertools.count():
+            due = start + i / rate
+            if due >= start + duration:
+                break
+            time.sleep(max(0, due - time.time()))
+            tx = StressTx(accounts[i % len(accounts)], due)
+            txs.append(tx)
+            executor.submit(send, tx)
+
+    deadline = time.time() + timeout
+    while time.time() < deadline and any(tx.sent and not tx.confirmed for tx in txs):
+        time.sleep(0.1)
+
+    unconfirmed = [tx for tx in txs if tx.sent and not tx.confirmed]
+    for tx in unconfirmed:
+        client.confirmations.forget(tx.txhash)
+    receipts = client.call_many([("eth_getTransactionReceipt", [tx.txhash]) for tx in unconfirmed],
+                                return_exceptions=True)
+    known = client.call_many([("eth_getTransactionByHash", [tx.txhash]) for tx in unconfirmed],
+                             return_exceptions=True)
+    senders_ = sorted({tx.sender for tx in unconfirmed})
+    mined_nonces = dict(zip(senders_, client.call_many(
+        [("eth_getTransactionCount", [sender, "latest"]) for sender in senders_])))
+    status = collections.Counter()
+    for tx, receipt, found in zip(unconfirmed, receipts, known):
+        if not isinstance(receipt, Exception) and receipt.get("blockHash"):
+            tx.receipt = Receipt(receipt)
+            status["mined"] += 1
+        elif int(mined_nonces[tx.sender], 16) > tx.nonce:
+            status["replaced"] += 1
+        elif isinstance(found, Exception):
+            status["dropped"] += 1
+        else:
+            status["pending"] += 1
+
+    confirmed = [tx for tx in txs if tx.confirmed]
+    mined_time = max((tx.included for tx in confirmed), default=start) - start
+    return {
+        "senders": senders,
+        "submitted": len(txs),
+        "rejected": sum(1 for tx in txs if tx.error),
+        "mined": len(confirmed) + status["mined"],
+        "mined_late": status["mined"],
+        "reverted": sum(1 for tx in txs if tx.receipt and tx.receipt["status"] != "0x1"),
+        "pending": status["pending"],
+        "replaced": status["replaced"],
+        "dropped": status["dropped"],
+        "submit_rate": len(txs) / duration,
+        "tps": len(confirmed) / mined_time if mined_time else 0,
+        "send": percentiles_ms([tx.sent - tx.submitted for tx in txs if tx.sent]),
+        "inclusion": percentiles_ms([tx.included - tx.submitted for tx in confirmed]),
+        "receipt": percentiles_ms([tx.confirmed - tx.submitted for tx in confirmed]),
+    }
+
+
+## Unit tests
+
+# Checks of the pure helpers, which need no node or compiler. Run with
+# `python3 tests.py unit`
+
+def unit_keccak():
+    # Against pycryptodome's Keccak-256, around the 136-byte rate
+    vectors = {
+        b"": "c5d2460186f7233c927e7db2dcc703c0e500b653ca82273b7bfad8045d85a470",
+        b"abc": "4e03657aea45a94fc7d47ba826c8d667c0d1e6e33a64a036ec44f58fa12d6c45",
+        b"a" * 135: "34367dc248bbd832f4e3e69dfaac2f92638bd0bbd18f2912ba4ef454919cf446",
+        b"a" * 136: "a6c4d403279fe3e0af03729caada8374b5ca54d8065329a3ebcaeb4b60aa386e",
+        b"a" * 137: "d869f639c7046b4929fc92a4d988a8b22c55fbadb802c0c66ebcd484f1915f39",
+        b"a" * 272: "cf7fcd4f705ee749930d19ca84561a9bf62516bd90a471545fa2f49fdc7e63c8",
+    }
+    for data, digest in vectors.items():
+        assert keccak256(data).hex() == digest, f"keccak256 of {len(data)} bytes"
+    assert function_selector("transfer(address,uint256)").hex() == "a9059cbb"
+
+def unit_rlp():
+    assert rlp_encode(b"") == bytes.fromhex("80")
+    assert rlp_encode(b"\x7f") == bytes.fromhex("7f")
+    assert rlp_encode(b"\x80") == bytes.fromhex("8180")
+    assert rlp_encode(b"dog") == bytes.fromhex("83646f67")
+    assert rlp_encode([]) == bytes.fromhex("c0")
+    assert rlp_encode([b"cat", b"dog"]) == bytes.fromhex("c88363617483646f67")
+    lorem = b"Lorem ipsum dolor sit amet, consectetur adipisicing elit"
+    assert rlp_encode(lorem) == bytes.fromhex("b838") + lorem
+    assert rlp_encode([lorem]) == bytes.fromhex("f83ab838") + lorem
+
+def unit_contract_address():
+    sender = "0x6ac7ea33f8831ea9dcc53393aaa88b25a785dbf0"
+    for nonce, address in [(0, "0xcd234a471b72ba2f1ccf0a70fcaba648a5eecd8d"),
+                           (1, "0x343c43a37d37dff08ae8c4a11544c718abb4fcf8"),
+                           (2, "0xf778b86fa74e846c4f0a1fbd1335fe81c00a0c91"),
+                           (3, "0xfffd933a0bc612844eaf0c6fe3e5b8e9b6c1d19c")]:
+        assert contract_address(sender, nonce) == address, f"nonce {nonce}"
+
+# Every way of splitting `body` in two, and in chunks of every size
+def chunkings(body):
+    for i in range(len(body) + 1):
+        yield [body[:i], body[i:]]
+    for size in range(1, len(body) + 1):
+        yield [body[i:i + size] for i in range(0, len(body), size)]
+
+def unit_json_stream():
+    items = [{"pc": 12345, "op": "PUSH1", "gas": 1.5e3, "stack": ["0x1", []]}, "ñ€", 0, None, 67890]
+    body = json.dumps({"jsonrpc": "2.0", "id": 1, "result": {"structLogs": items, "gas": 7}})
+    for chunks in chunkings(body.encode()):
+        assert list(JSONStream(chunks).items(("result", "structLogs"))) == items, chunks
+
+    for chunks in chunkings(b'{"id": 1, "result": 12}'):
+        assert list(JSONStream(chunks).items(("result",))) == [12], chunks
+    assert list(JSONStream([b'{"result": []}']).items(("result",))) == []
+
+    for body, error in [(b'{"id": 1, "error": {"code": -32000}, "result": []}', RPCError),
+                        (b'{"id": 1, "result": null}', Exception),
+                        (b'{"id": 1}', KeyError),
+                        (b'{"id": 1, "result": [1, 2', ValueError)]:
+        for chunks in chunkings(body):
+            try:
+                list(JSONStream(chunks).items(("result",)))
+            except error:
+                continue
+            raise AssertionError(f"{body} didn't raise {error.__name__}")
+
+def unit_abi():
+    types = ["uint256", "int8", "address", "bool", "bytes4", "bytes", "string", "uint16[]", "string[]"]
+    values = (2**256 - 1, -128, "0x00a329c0648769a73afac7f9381e08fb43dbea72", True, b"\xa9\x05\x9c\xbb",
+              b"\x01" * 33, "ñ" * 20, [1, 2, 65535], ["a", "", "b" * 40])
+    for pad in (True, False):
+        encoded = abi_encode(types, values, pad)
+        assert abi_decode(types, encoded) == values
+        assert len(encoded) % 32 == (0 if pad else 8)
+
+    # Against calldata built by hand
+    calldata = encode_call("transfer(address,uint256)", "0x" + "aa" * 20, 0xead)
+    assert calldata.hex() == "a9059cbb" + "0" * 24 + "aa" * 20 + "0" * 61 + "ead"
+    assert decode_call("transfer(address,uint256)", calldata) == ("0x" + "aa" * 20, 0xead)
+
+    # Unpadded last dynamic value: accepted, unless strict
+    unpadded = abi_encode(["bytes"], [b"\x01" * 36], pad=False)
+    assert abi_decode(["bytes"], unpadded) == (b"\x01" * 36,)
+    for types, data, strict in [(["bytes"], unpadded, True),
+                                (["uint256", "uint256"], bytes(63), False),
+                                (["bytes"], abi_encode(["bytes"], [b"\x01" * 36])[:-32], False),
+                                (["bytes"], (64).to_bytes(32, "big") + bytes(32), False),
+                                (["uint8[]"], (32).to_bytes(32, "big") + b"\xff" * 32, False),
+                                (["string[]"], (32).to_bytes(32, "big") + (2**40).to_bytes(32, "big"), False)]:
+        try:
+            abi_decode(types, data, strict)
+        except ValueError:
+            continue
+        raise AssertionError(f"{types} {data.hex()} decoded (strict={strict})")
+    try:
+        decode_call("approve(address,uint256)", calldata)
+        raise AssertionError("Selector not checked")
+    except ValueError:
+        pass
+
+    # Columns, with and without NumPy, match the values decoded one by one
+    types = ["uint64", "uint256", "int32", "address", "bool", "bytes2"]
+    rows = [(5, 2**200, -1, "0x" + "bb" * 20, False, b"\x12\x34"),
+            (2**64 - 1, 0, 2**31 - 1, "0x" + "00" * 20, True, b"\x00\x00")]
+    datas = [abi_encode(types, row) for row in rows]
+    # A uint64 word with high bytes set keeps them, as abi_decode does
+    datas.append((2**70 + 3).to_bytes(32, "big") + datas[0][32:])
+    expected = [list(column) for column in zip(*(abi_decode(types, data) for data in datas))]
+    global numpy
+    numpy_ = numpy
+    try:
+        for numpy in {numpy_, None}:
+            assert abi_decode_columns(types, datas) == expected, f"numpy={numpy is not None}"
+    finally:
+        numpy = numpy_
+
+def unit_null_result():
+    assert has_null_result(b'{"jsonrpc":"2.0","id":1,"result":null}')
+    assert has_null_result(b'[{"id":1,"result":"0x1"},{"id":2,"result": null}]')
+    # Nulls nested in a result (trace rewards, failed frames) aren't missing data
+    assert not has_null_result(b'{"id":1,"result":[{"result":null,"type":"reward"}]}')
+    assert not has_null_result(b'{"id":1,"error":{"code":-32000,"message":"result: null"}}')
+
+def unit_records():
+    receipt = {"transactionHash": "0x" + "11" * 32, "transactionIndex": "0x0",
+               "blockHash": "0x" + "22" * 32, "blockNumber": "0x1b4", "from": "0x" + "aa" * 20,
+               "to": None, "cumulativeGasUsed": "0x5208", "gasUsed": "0x5208",
+               "contractAddress": "0x" + "bb" * 20, "logsBloom": "0x" + "00" * 256,
+               "logs": [{"address": "0x" + "bb" * 20, "topics": ["0x" + "33" * 32], "data": "0x",
+                         "blockHash": "0x" + "22" * 32, "blockNumber": "0x1b4",
+                         "transactionHash": "0x" + "11" * 32, "transactionIndex": "0x0",
+                         "logIndex": "0x00", "removed": False, "blockTimestamp": "0x5"}],
+               "status": "0x1", "type": "0x2", "effectiveGasPrice": "0x3b9aca00",
+               "blobGasUsed": "0x20000", "l1Fee": "0x12"}
+    record = Receipt(receipt)
+    assert record == receipt and record.to_dict() == receipt
+    assert record["blobGasUsed"] == "0x20000" and "l1Fee" in record.keys()
+    assert record.block_number == 0x1b4 and record.gas_used == 21000
+    # Non canonical quantities keep their original string once read as ints
+    log = record.logs[0]
+    assert log.log_index == 0 and log["logIndex"] == "0x00" and log == receipt["logs"][0]
+    assert TraceFrame({"type": "CALL", "value": "0x0"})["value"] == "0x0"
+
+# A CALL (with `value`, handing 50000 gas over) into a callee running
+# `callee` ((opcode, cost) pairs), as Geth struct logs and as an
+# OpenEthereum vmTrace. The CALL costs `base`, and the callee gets the
+# stipend on top of the gas handed over
+def call_traces(value, base, callee):
+    handed, stipend = 50000, CALL_STIPEND if value else 0
+    pushes = ["0x0"] * 4 + [hex(value), "0x" + "bb" * 20, hex(handed)]
+    code = bytes.fromhex("6000" * 4 + "60%02x" % value + "73" + "bb" * 20 + "61c350" + "f100")
+    callee_code = bytes(op for op, _ in callee)
+    steps, ops, gas = [], [], 100000
+    for pc, push in zip([0, 2, 4, 6, 8, 10, 31], pushes):
+        steps.append({"pc": pc, "op": opcode_name(code, pc), "gas": gas, "gasCost": 3, "depth": 1,
+                      "stack": pushes[:len(steps)]})
+        gas -= 3
+        ops.append({"pc": pc, "cost": 3, "ex": {"used": gas, "push": [push]}, "sub": None})
+    steps.append({"pc": 34, "op": "CALL", "gas": gas, "gasCost": base + handed, "depth": 1,
+                  "stack": pushes})
+    sub_gas, sub_ops = handed + stipend, []
+    for pc, (op, cost) in enumerate(callee):
+        steps.append({"pc": pc, "op": OPCODES[op], "gas": sub_gas, "gasCost": cost, "depth": 2,
+                      "stack": ["0x0"] * 2})
+        sub_gas -= cost
+        sub_ops.append({"pc": pc, "cost": cost, "ex": {"used": sub_gas, "push": []}, "sub": None})
+    gas = gas - base - handed + sub_gas
+    ops.append({"pc": 34, "cost": base + handed, "ex": {"used": gas, "push": ["0x1"]},
+                "sub": {"code": prepend_0x(callee_code.hex()), "ops": sub_ops}})
+    steps.append({"pc": 35, "op": "STOP", "gas": gas, "gasCost": 0, "depth": 1, "stack": ["0x1"]})
+    ops.append({"pc": 35, "cost": 0, "ex": {"used": gas, "push": []}, "sub": None})
+    return steps, ops, code
+
+def unit_gas_profile():
+    push, stop, revert = 0x60, 0x00, 0xfd
+    for value, base, callee in [(0, 700, [(push, 3), (stop, 0)]),
+                                (5, 9700, [(push, 3), (stop, 0)]),
+                                (5, 9700, [(push, 3), (push, 3), (revert, 0)])]:
+        steps, ops, code = call_traces(value, base, callee)
+        for profile in (profile_struct_logs(steps, "root"), profile_vm_trace(ops, code, "root")):
+            frames = profile.frames()
+            assert [gas for (_, pc, op), (_, gas) in profile.ops.items() if op == "CALL"] == [base]
+            assert frames[("root",)][1] == 7 * 3 + base
+            (callee_path,) = [path for path in frames if len(path) == 2]
+            assert frames[callee_path][1] == sum(cost for _, cost in callee)
+            assert frames[("root",)][2] == 7 * 3 + base + sum(cost for _, cost in callee)
+
+UNIT_TESTS = [unit_keccak, unit_rlp, unit_contract_address, unit_json_stream, unit_abi,
+              unit_null_result, unit_records, unit_gas_profile]
+
+def unit_main(argv=None):
+    parser = argparse.ArgumentParser(prog="tests.py unit")
+    parser.add_argument("names", metavar="NAME", nargs="*", help="Tests to run (default: all)")
+    args = parser.parse_args(argv)
+
+    failed = 0
+    for test in UNIT_TESTS:
+        if args.names and test.__name__ not in args.names:
+            continue
+        print(f" - '{test.__name__}'... ", end="")
+        start = time.time()
+        try:
+            test()
+            print(f"OK ({elapsed_since(start)})")
+        except Exception:
+            failed += 1
+            print(f"ERROR ({elapsed_since(start)})")
+            traceback.print_exc()
+    if failed:
+        sys.exit(1)
 
 
 ## Tests
 
 def test_extra_parameter(client):
     code = compile("src/TestToken.sol")
-    sender = client.eth_accounts()[0]
+    sender = client.default_account()
     contractAddress = deploy_contract(client, sender, code)
 
     # Call transfer() including an extra parameter, with a different value:
@@ -273,7 +4059,7 @@ def test_extra_parameter(client):
 
 def test_bad_balance_check(client):
     code = compile("src/UnsafeToken.sol")
-    sender = client.eth_accounts()[0]
+    sender = client.default_account()
     contractAddress = deploy_contract(client, sender, code)
 
     # Call transfer() with a big amount, to make the check fail:
@@ -305,7 +4091,7 @@ def test_bad_balance_check(client):
     assert balance == prepend_0x(zeropad('00', 64)), f"Balance is {balance}"
 
 def test_impersonate(client):
-    sender = client.eth_accounts()[0]
+    sender = client.default_account()
 
     token = compile("src/TestToken.sol")
     tokenAddress = deploy_contract(client, sender, token)
@@ -375,16 +4161,20 @@ def test_impersonate(client):
 def test_extra_log_data(client):
     token_code = compile("src/TestToken.sol")
     runner_code = compile("src/Runner.sol")
-    sender = client.eth_accounts()[0]
-    token_address = deploy_contract(client, sender, token_code)
-    runner_address = deploy_contract(client, sender, runner_code)
+    sender = client.default_account()
+
+    # Deploy both contracts and fund the runner without waiting in between:
+    token_tx, token_address = submit_deploy(client, sender, token_code)
+    runner_tx, runner_address = submit_deploy(client, sender, runner_code)
 
     # Fund runner contract with some tokens
-    contract_send_tx(client, sender, token_address, 
+    fund_tx, _ = submit_tx(client, sender, token_address,
         "0xa9059cbb" +
           zeropad(remove_0x(runner_address), 64) +
           "0000000000000000000000000000000000000000000000000000000000002000")
 
+    wait_receipts(client, [token_tx, runner_tx, fund_tx], "Setup failed")
+
     # Submit tx to send from runner to dummy address
     submit_receipt = contract_send_tx(client, sender, runner_address, 
         "0xc6427474" +
@@ -444,16 +4234,20 @@ def test_extra_log_data(client):
 def test_partial_revert(client):
     token_code = compile("src/TestToken.sol")
     runner_code = compile("src/Runner.sol")
-    sender = client.eth_accounts()[0]
-    token_address = deploy_contract(client, sender, token_code)
-    runner_address = deploy_contract(client, sender, runner_code)
+    sender = client.default_account()
+
+    # Deploy both contracts and fund the runner without waiting in between:
+    token_tx, token_address = submit_deploy(client, sender, token_code)
+    runner_tx, runner_address = submit_deploy(client, sender, runner_code)
 
     # Fund runner contract with some tokens
-    contract_send_tx(client, sender, token_address, 
+    fund_tx, _ = submit_tx(client, sender, token_address,
         "0xa9059cbb" +
           zeropad(remove_0x(runner_address), 64) +
           "0000000000000000000000000000000000000000000000000000000000002000")
 
+    wait_receipts(client, [token_tx, runner_tx, fund_tx], "Setup failed")
+
     # Submit valid tx to send some tokens:
     contract_send_tx(client, sender, runner_address, 
         "0xc6427474" +
@@ -546,46 +4340,310 @@ def test_partial_revert(client):
 def elapsed_since(start):
     return "%.2fs" % (time.time() - start)
 
-def run_tests(tests):
-    errors = []
+# New accounts (with an empty password), funded from the first node account
+def create_funded_accounts(client, count, value=10**18):
+    funder = client.eth_accounts()[0]
+    accounts = [client._call("personal_newAccount", [""]) for _ in range(count)]
+    txhashes = [submit_tx(client, funder, account, "0x", 21000, value)[0] for account in accounts]
+    wait_receipts(client, txhashes, "Funding failed")
+    return accounts
 
-    for test, client in tests:
-        try:
-            sys.stdout.write(f" - '{test.__name__}' ({client.desc})... ")
-            sys.stdout.flush()
-            start = time.time()
+def run_test(test, client, results, lock, progress):
+    if progress:
+        sys.stdout.write(f" - '{test.__name__}' ({client.desc})... ")
+        sys.stdout.flush()
+    start = time.time()
+    try:
+        with client.metrics.scope(f"{test.__name__} ({client.desc})"):
             test(client)
-            sys.stdout.write(f"OK ({elapsed_since(start)})\n")
-        except Exception as e:
-            _, _, tb = sys.exc_info()
-            errors.append((test, client, e, tb))
-            sys.stdout.write(f"ERROR ({elapsed_since(start)})\n")
+        error = None
+    except Exception as e:
+        _, _, tb = sys.exc_info()
+        error = (e, tb)
+    elapsed = time.time() - start
+    status = "ERROR" if error else "OK"
+    with lock:
+        if not progress:
+            sys.stdout.write(f" - '{test.__name__}' ({client.desc})... ")
+        sys.stdout.write(f"{status} ({elapsed:.2f}s)\n")
+        sys.stdout.flush()
+        results.append((test, client, elapsed, error))
+
+# With jobs > 1, each client runs its tests in `jobs` worker threads, each one
+# sending from its own funded account so their nonces don't collide. All
+# the clients run at the same time. With profile=True the calls made by
+# each test are broken down at the end
+def run_tests(tests, jobs=1, profile=False):
+    results = []
+    lock = threading.Lock()
+    start = time.time()
+
+    if jobs == 1:
+        for test, client in tests:
+            run_test(test, client, results, lock, True)
+    else:
+        def worker(client, queue):
+            while True:
+                try:
+                    test = queue.popleft()
+                except IndexError:
+                    return
+                run_test(test, client, results, lock, False)
 
-    for (test, client, exc, tb) in errors:
-        print(f"\nError in '{test.__name__}' ({client.desc}): {exc}\n")
-        traceback.print_tb(tb)
+        def start_workers(client):
+            queue = collections.deque(test for test, c in tests if c is client)
+            try:
+                accounts = create_funded_accounts(client, min(jobs, len(queue)))
+            except Exception as e:
+                with lock:
+                    results.extend((test, client, 0, (e, sys.exc_info()[2])) for test in queue)
+                return
+            threads = [threading.Thread(target=worker, args=(client.for_account(account), queue))
+                       for account in accounts]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        clients = list({id(client): client for _, client in tests}.values())
+        threads = [threading.Thread(target=start_workers, args=(client,)) for client in clients]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    wall_clock = time.time() - start
+    summed = sum(elapsed for _, _, elapsed, _ in results)
+    print(f"\n{len(results)} tests in {wall_clock:.2f}s (summed test time {summed:.2f}s, "
+          f"{summed / wall_clock if wall_clock else 0:.1f}x)")
+
+    for (test, client, _, error) in results:
+        if error:
+            exc, tb = error
+            print(f"\nError in '{test.__name__}' ({client.desc}): {exc}\n")
+            traceback.print_tb(tb)
+
+    if profile:
+        metrics = {id(client.metrics): client.metrics for _, client in tests}
+        for m in metrics.values():
+            m.report_tests(results)
+            m.report()
 
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("--verbose", action="store_true", default=False)
+    parser.add_argument("--pool-size", type=int, default=10)
+    parser.add_argument("--timeout", type=float, default=30)
+    parser.add_argument("--retries", type=int, default=2)
+    parser.add_argument("--cache", metavar="PATH",
+                        help="SQLite file to persist immutable RPC results")
+    parser.add_argument("--jobs", type=int, default=1,
+                        help="Tests to run at the same time on each client")
+    parser.add_argument("--record", metavar="PATH", nargs="?", const="recording.jsonl",
+                        help="Record all requests and responses (default: recording.jsonl)")
+    parser.add_argument("--replay", metavar="PATH", nargs="?", const="recording.jsonl",
+                        help="Answer from a recording instead of the nodes")
+    parser.add_argument("--openeth", metavar="HOST:PORT", action="append",
+                        help="OpenEthereum node (repeat to pool several, default: localhost:8545)")
+    parser.add_argument("--geth", metavar="HOST:PORT", action="append",
+                        help="Geth node (repeat to pool several, default: localhost:8546)")
+    parser.add_argument("--hedge", action="store_true", default=False,
+                        help="Resend pooled reads running past the p95 latency to another node")
+    parser.add_argument("--evm", action="store_true", default=False,
+                        help="Run the tests on an in-process EVM instead of the nodes")
+    parser.add_argument("--profile", action="store_true", default=False,
+                        help="Print the RPC calls made by each test")
+    parser.add_argument("--bench", choices=BENCHMARKS.keys())
     args = parser.parse_args()
+    if args.jobs < 1:
+        parser.error("--jobs must be at least 1")
+
+    if args.bench:
+        BENCHMARKS[args.bench]()
+        return
+
+    def transport():
+        return PooledTransport(args.pool_size, args.timeout, args.retries)
+
+    if args.replay:
+        shared = ReplayTransport(args.replay)
+        transport = lambda: shared
+    elif args.record:
+        shared = RecordingTransport(transport(), args.record)
+        transport = lambda: shared
+
+    if args.evm:
+        clients = [EVMClient(args.verbose)]
+    else:
+        cache = RPCCache(path=args.cache)
 
-    openeth_client = OpenEthereumClient("localhost", "8545", args.verbose)
-    geth_client = GethClient("localhost", "8546", args.verbose)
+        def node_client(cls, nodes):
+            clients = [cls(*node.rsplit(":", 1), args.verbose, transport(), cache) for node in nodes]
+            if len(clients) == 1:
+                return clients[0]
+            return EndpointPool(clients, hedge=args.hedge).client()
+
+        clients = [node_client(OpenEthereumClient, args.openeth or ["localhost:8545"]),
+                   node_client(GethClient, args.geth or ["localhost:8546"])]
 
     run_tests([
-        (test_extra_parameter, openeth_client),
-        (test_extra_log_data, openeth_client),
-        (test_extra_parameter, geth_client),
-        (test_extra_log_data, geth_client),
-        (test_partial_revert, openeth_client),
-        (test_partial_revert, geth_client),
-        (test_bad_balance_check, openeth_client),
-        (test_bad_balance_check, geth_client),
-        (test_impersonate, openeth_client),
-        (test_impersonate, geth_client),
-    ])
+        (test, client)
+        for test in [test_extra_parameter, test_extra_log_data, test_partial_revert,
+                     test_bad_balance_check, test_impersonate]
+        for client in clients
+    ], args.jobs, args.profile)
+
+# Runs the request templates against both nodes at the same time and prints
+# a JSON report, e.g. `python3 tests.py load --rate 200 --duration 30`
+def load_main(argv=None):
+    parser = argparse.ArgumentParser(prog="tests.py load")
+    parser.add_argument("templates", metavar="TEMPLATE", nargs="*",
+                        help=f"Request templates (default: {LOAD_TEMPLATES}/*.txt)")
+    parser.add_argument("--rate", type=float,
+                        help="Requests per second on each node (default: as fast as possible)")
+    parser.add_argument("--concurrency", type=int, default=10,
+                        help="Requests in flight on each node")
+    parser.add_argument("--duration", type=float, default=10)
+    parser.add_argument("--stub", action="store_true", default=False,
+                        help="Run against local stub servers instead of the nodes")
+    parser.add_argument("--output", metavar="PATH", help="Write the report to PATH")
+    args = parser.parse_args(argv)
+
+    paths = args.templates or sorted(glob.glob(os.path.join(LOAD_TEMPLATES, "*.txt")))
+    templates = {os.path.splitext(os.path.basename(path))[0]: load_template(path)
+                 for path in paths}
+
+    with contextlib.ExitStack() as stack:
+        if args.stub:
+            endpoints = [(server.host, server.port) for server in
+                         [stack.enter_context(StubRPCServer()) for _ in range(2)]]
+        else:
+            endpoints = [("localhost", "8545"), ("localhost", "8546")]
+        clients = [cls(host, port, False, PooledTransport(args.concurrency))
+                   for cls, (host, port) in zip([OpenEthereumClient, GethClient], endpoints)]
+
+        # Both nodes are set up first, then loaded at the same time
+        barrier = threading.Barrier(len(clients))
+
+        def run(client):
+            try:
+                context = STUB_CONTEXT if args.stub else load_context(client, templates)
+            except Exception:
+                barrier.abort()
+                raise
+            calls = [(name, *load_call(client, *render_template(template, context)))
+                     for name, template in templates.items()]
+            barrier.wait()
+            return run_load(client, calls, args.duration, args.rate, args.concurrency)
+
+        with concurrent.futures.ThreadPoolExecutor(len(clients)) as executor:
+            futures = {client.desc: executor.submit(run, client) for client in clients}
+            results = {desc: future.result() for desc, future in futures.items()}
+
+    report = json.dumps({
+        "templates": list(templates),
+        "rate": args.rate,
+        "concurrency": args.concurrency,
+        "duration": args.duration,
+        "stub": args.stub,
+        "results": results,
+    }, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(report + "\n")
+    else:
+        print(report)
+
+# Pushes transfers to both nodes at the same time at a target rate and prints
+# a JSON report, e.g. `python3 tests.py stress --rate 100 --senders 50`
+def stress_main(argv=None):
+    parser = argparse.ArgumentParser(prog="tests.py stress")
+    parser.add_argument("--rate", type=float, default=10, help="Txs per second on each node")
+    parser.add_argument("--senders", type=int, default=10,
+                        help="New funded accounts sending the txs")
+    parser.add_argument("--duration", type=float, default=10)
+    parser.add_argument("--timeout", type=float, default=60,
+                        help="Seconds to wait for the txs to be mined after the last submit")
+    parser.add_argument("--token", action="store_true", default=False,
+                        help="Send TestToken transfers instead of value transfers")
+    parser.add_argument("--output", metavar="PATH", help="Write the report to PATH")
+    args = parser.parse_args(argv)
+
+    clients = [OpenEthereumClient("localhost", "8545", False, PooledTransport(args.senders)),
+               GethClient("localhost", "8546", False, PooledTransport(args.senders))]
+    with concurrent.futures.ThreadPoolExecutor(len(clients)) as executor:
+        futures = {client.desc: executor.submit(run_stress, client, args.rate, args.senders,
+                                                args.duration, args.token, args.timeout)
+                   for client in clients}
+        results = {desc: future.result() for desc, future in futures.items()}
+
+    report = json.dumps({
+        "rate": args.rate,
+        "senders": args.senders,
+        "duration": args.duration,
+        "token": args.token,
+        "results": results,
+    }, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(report + "\n")
+    else:
+        print(report)
+
+# Where the gas of a tx goes, per call frame and opcode, e.g.
+# `python3 tests.py profile 0x... --node geth --folded gas.folded`
+def profile_main(argv=None):
+    parser = argparse.ArgumentParser(prog="tests.py profile")
+    parser.add_argument("txhash")
+    parser.add_argument("--node", choices=["openeth", "geth"], default="geth")
+    parser.add_argument("--top", type=int, default=20, help="Frames and opcodes to show")
+    parser.add_argument("--folded", metavar="PATH",
+                        help="Write the stacks for a flame graph (flamegraph.pl, speedscope) to PATH")
+    args = parser.parse_args(argv)
+
+    if args.node == "geth":
+        client = GethClient("localhost", "8546", False)
+    else:
+        client = OpenEthereumClient("localhost", "8545", False)
+    profile = client.profile_gas(args.txhash)
+    profile.report(args.top)
+    if args.folded:
+        with open(args.folded, "w") as f:
+            f.write("\n".join(profile.folded()) + "\n")
+
+# Compares the receipts and traces of the same txs on both nodes, e.g.
+# `python3 tests.py diff --file txhashes.txt` (when both follow the same chain)
+def diff_main(argv=None):
+    parser = argparse.ArgumentParser(prog="tests.py diff")
+    parser.add_argument("txhashes", metavar="TXHASH", nargs="*")
+    parser.add_argument("--file", metavar="PATH", help="File with one tx hash per line")
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument("--max-divergent", type=int, help="Stop after this many divergent txs")
+    parser.add_argument("--first-only", action="store_true", default=False,
+                        help="Report only the first divergence of each tx")
+    args = parser.parse_args(argv)
+
+    txhashes = list(args.txhashes)
+    if args.file:
+        with open(args.file) as f:
+            txhashes += [line.strip() for line in f if line.strip()]
+    diff = TraceDiff(OpenEthereumClient("localhost", "8545", False, PooledTransport(args.workers)),
+                     GethClient("localhost", "8546", False, PooledTransport(args.workers)),
+                     workers=args.workers, first_only=args.first_only,
+                     max_divergent=args.max_divergent)
+    diff.compare_hashes(txhashes).print()
+
+COMMANDS = {
+    "load": load_main,
+    "diff": diff_main,
+    "stress": stress_main,
+    "profile": profile_main,
+    "unit": unit_main,
+}
 
 if __name__ == '__main__':
-    main()
+    if sys.argv[1:2] and sys.argv[1] in COMMANDS:
+        COMMANDS[sys.argv[1]](sys.argv[2:])
+    else:
+        main()
 